@@ -746,21 +746,21 @@
 
 import os
 import yt_dlp
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import re
 import uuid
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs
 import json
 import time
 import glob
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, Any, Optional
+from typing import Dict, List, Optional
 import threading
 from datetime import datetime, timedelta
 import tempfile
@@ -768,6 +768,22 @@ import shutil
 from fastapi.responses import StreamingResponse
 from datetime import timedelta
 import random
+import sys
+import httpx
+from starlette.background import BackgroundTask
+import anyio
+from collections import OrderedDict, deque
+import math
+import heapq
+import itertools
+import bisect
+from email.utils import formatdate
+import socket
+import sqlite3
+import zipfile
+import hashlib
+import io
+from PIL import Image
 
 # Pydantic models
 class URLRequest(BaseModel):
@@ -775,9 +791,14 @@ class URLRequest(BaseModel):
     content_type: Optional[str] = None
     original_url: Optional[str] = None
 
+class BatchURLRequest(BaseModel):
+    urls: List[str]
+    content_type: Optional[str] = None
+
 class DownloadRequest(BaseModel):
     session_id: str
     format_id: str = None
+    items: Optional[List[int]] = None  # Carousel item indexes (1-based); all items if omitted
 
 app = FastAPI(title="Instagram Downloader API - Enhanced Cloud Support")
 
@@ -803,629 +824,2896 @@ os.makedirs('static', exist_ok=True)
 os.makedirs('templates', exist_ok=True)
 os.makedirs('output', exist_ok=True)
 
-# Global variables
-video_cache = {}
-download_jobs: Dict[str, Dict[str, Any]] = {}
-job_lock = threading.Lock()
-executor = ThreadPoolExecutor(max_workers=10)  # Reduced for cloud stability
+# ✅ METRICS PRIMITIVES (rendered by /metrics in the Prometheus text format)
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)  # seconds
+
+def metric_labels(names, values):
+    """'{a="x",b="y"}' for a label set, with Prometheus escaping"""
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class Counter:
+    """Monotonic counter per label set"""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} counter'
+        for key, value in values:
+            yield f'{self.name}{metric_labels(self.labels, key)} {value}'
+
+class Histogram:
+    """Fixed-bucket histogram per label set; observe() is a bisect and three adds"""
+
+    def __init__(self, name, description, labels=(), buckets=METRIC_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series: Dict[tuple, list] = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} histogram'
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                yield f'{self.name}_bucket{metric_labels(self.labels + ("le",), key + (bound,))} {cumulative}'
+            yield f'{self.name}_sum{metric_labels(self.labels, key)} {round(values[-2], 6)}'
+            yield f'{self.name}_count{metric_labels(self.labels, key)} {values[-1]}'
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that tracks how many of its threads are busy"""
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers)
+        self.max_workers = max_workers
+        self.busy = 0
+        self._busy_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        def tracked():
+            with self._busy_lock:
+                self.busy += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._busy_lock:
+                    self.busy -= 1
+        return super().submit(tracked)
+
+    def queue_depth(self):
+        """Submitted calls still waiting for a thread"""
+        return self._work_queue.qsize()
+
+http_request_duration = Histogram(
+    'instagram_http_request_duration_seconds', 'Time from request to last body byte, per route', ('route',)
+)
+ytdlp_attempt_duration = Histogram(
+    'instagram_ytdlp_attempt_duration_seconds', 'yt-dlp time per extract/download attempt', ('stage',)
+)
+download_duration = Histogram('instagram_download_duration_seconds', 'Time to fetch a job\'s media, retries included')
+queue_wait_duration = Histogram('instagram_queue_wait_duration_seconds', 'Time a download job waited for a worker')
+postprocess_duration = Histogram(
+    'instagram_postprocess_duration_seconds', 'ffmpeg run time per post-processing signature', ('signature',)
+)
+errors_total = Counter('instagram_errors_total', 'Failures by pipeline stage and error_type', ('stage', 'error_type'))
+
+# Global variables (video_cache and download_jobs are bounded stores, created below)
+executor = InstrumentedExecutor(max_workers=10)  # Reduced for cloud stability
 
 # Cleanup tracking
 temp_files = {}
 temp_files_lock = threading.Lock()
 
-class InstagramDownloader:
+# ✅ SHARED STATE BACKEND
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')  # 'memory', 'sqlite' or 'redis'
+STATE_SQLITE_PATH = os.environ.get('STATE_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'instagram_state.db'))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
+STATE_KEY_PREFIX = 'igdl:'
+STATE_READ_THREADS = int(os.environ.get('STATE_READ_THREADS', 4))
+
+class StateBackend:
+    """Key/value store for sessions, jobs and files that every server worker can read
+    
+    Values are JSON documents with a TTL. Backend failures are logged and counted
+    rather than raised, so a flaky store degrades to per-worker state.
+    
+    get/set block on the store. The event loop uses get_async, run and
+    set_later instead: reads run on a small thread pool, writes on a single
+    thread so they land in the order they were made.
+    """
+
+    shared = True  # False when sibling workers cannot see what this one writes
+
     def __init__(self):
-        # ✅ ENHANCED USER AGENTS FOR CLOUD DEPLOYMENT
-        self.user_agents = [
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0'
-        ]
-        
-        # ✅ ENHANCED HEADERS TO MIMIC REAL BROWSER
-        self.headers = {
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'Sec-Fetch-User': '?1',
-            'Cache-Control': 'max-age=0',
-        }
-        
-        self.extract_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True,
-            'extract_flat': False,
-            'writesubtitles': False,
-            'writeautomaticsub': False,
-            'socket_timeout': 45,  # Increased timeout
-            'retries': 5,  # More retries
-            'user_agent': random.choice(self.user_agents),
-            # ✅ ENHANCED BYPASS OPTIONS
-            'http_headers': self.headers,
-            'sleep_interval': 1,  # Add delay between requests
-            'max_sleep_interval': 3,
-            'sleep_interval_subtitles': 1,
-            'ignoreerrors': False,
-            'no_check_certificate': True,
-            # ✅ INSTAGRAM SPECIFIC OPTIONS
-            'extractor_args': {
-                'instagram': {
-                    'api_version': 'v1',
-                    'include_stories': False
-                }
-            }
-        }
-        
-        # ✅ ENHANCED DOWNLOAD OPTIONS FOR CLOUD
-        self.download_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extractaudio': False,
-            'writesubtitles': False,
-            'writeautomaticsub': False,
-            'socket_timeout': 60,
-            'retries': 8,  # Even more retries for download
-            'user_agent': random.choice(self.user_agents),
-            'http_headers': self.headers,
-            'sleep_interval': 2,  # Longer delay for downloads
-            'max_sleep_interval': 5,
-            'no_check_certificate': True,
-            'prefer_insecure': False,
-            # ✅ QUALITY SETTINGS
-            'format_sort': ['res:1080', 'fps', 'hdr:12', 'codec:h264', 'size', 'br', 'asr'],
-            'format_sort_force': True,
-            # ✅ INSTAGRAM SPECIFIC BYPASS
-            'extractor_args': {
-                'instagram': {
-                    'api_version': 'v1',
-                    'include_stories': False,
-                    'comment_count': 0,
-                    'like_count': 0
-                }
-            }
-        }
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+        self._readers = ThreadPoolExecutor(max_workers=STATE_READ_THREADS, thread_name_prefix='state-read')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-write')
 
-    def get_random_config(self, base_opts):
-        """Get randomized config to avoid detection"""
-        config = base_opts.copy()
-        config['user_agent'] = random.choice(self.user_agents)
-        config['socket_timeout'] = random.randint(30, 60)
-        config['sleep_interval'] = random.uniform(1, 3)
-        return config
+    def get(self, namespace, key):
+        self.reads += 1
+        try:
+            raw = self._get(f'{STATE_KEY_PREFIX}{namespace}:{key}')
+        except Exception as e:
+            self._failed('get', e)
+            return None
+        return json.loads(raw) if raw is not None else None
 
-    def is_valid_instagram_url(self, url):
-        """Check if URL is valid Instagram URL"""
-        patterns = [
-            r'https?://(?:www\.)?instagram\.com/p/[A-Za-z0-9_-]+',
-            r'https?://(?:www\.)?instagram\.com/reel/[A-Za-z0-9_-]+',
-            r'https?://(?:www\.)?instagram\.com/reels/[A-Za-z0-9_-]+',
-            r'https?://(?:www\.)?instagram\.com/tv/[A-Za-z0-9_-]+',
-            r'https?://(?:www\.)?instagram\.com/stories/[A-Za-z0-9_.-]+/[0-9]+',
-        ]
-        
-        for pattern in patterns:
-            if re.match(pattern, url):
-                return True
-        return False
+    def set(self, namespace, key, value, ttl):
+        self._write(namespace, key, json.dumps(value, default=str), ttl)
 
-    def detect_content_type(self, url):
-        """Detect content type from URL"""
-        if '/stories/' in url:
-            return 'story'
-        elif '/reels/' in url or '/reel/' in url:
-            return 'reel'
-        elif '/p/' in url:
-            return 'post'
-        elif '/tv/' in url:
-            return 'igtv'
-        return 'unknown'
+    def _write(self, namespace, key, raw, ttl):
+        self.writes += 1
+        try:
+            self._set(f'{STATE_KEY_PREFIX}{namespace}:{key}', raw, max(1, int(ttl)))
+        except Exception as e:
+            self._failed('set', e)
 
-    def extract_info(self, url, content_type=None):
-        """Extract video information with enhanced error handling"""
-        max_attempts = 3
-        
-        for attempt in range(max_attempts):
-            try:
-                # ✅ Handle stories immediately
-                if content_type == 'story':
-                    return {
-                        'success': False,
-                        'error': 'Instagram Stories are not supported',
-                        'error_type': 'story_not_supported',
-                        'message': 'Stories cannot be downloaded due to Instagram restrictions'
-                    }
-                
-                # ✅ ADD DELAY BETWEEN ATTEMPTS
-                if attempt > 0:
-                    time.sleep(random.uniform(2, 5))
-                
-                # Get randomized config for this attempt
-                extract_opts = self.get_random_config(self.extract_opts)
-                
-                with yt_dlp.YoutubeDL(extract_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    
-                return {
-                    'success': True,
-                    'data': info,
-                    'content_type': content_type
-                }
-                
-            except yt_dlp.DownloadError as e:
-                error_msg = str(e).lower()
-                
-                # ✅ ENHANCED ERROR DETECTION
-                if any(keyword in error_msg for keyword in ['login', 'cookies', 'authentication', 'sign in']):
-                    if attempt < max_attempts - 1:
-                        continue  # Retry with different config
-                    return {
-                        'success': False,
-                        'error': 'This content requires authentication or is rate-limited',
-                        'error_type': 'authentication_required',
-                        'suggestion': 'Try again in a few minutes or use a different post'
-                    }
-                elif any(keyword in error_msg for keyword in ['private', 'unavailable', 'not found']):
-                    return {
-                        'success': False,
-                        'error': 'Content is private or unavailable',
-                        'error_type': 'content_unavailable'
-                    }
-                elif 'rate' in error_msg:
-                    if attempt < max_attempts - 1:
-                        time.sleep(random.uniform(5, 10))  # Longer wait for rate limit
-                        continue
-                    return {
-                        'success': False,
-                        'error': 'Rate limit reached. Please try again later.',
-                        'error_type': 'rate_limit'
-                    }
-                else:
-                    if attempt < max_attempts - 1:
-                        continue
-                    return {
-                        'success': False,
-                        'error': f'Extraction failed: {str(e)}',
-                        'error_type': 'extraction_error'
-                    }
-                    
-            except Exception as e:
-                if attempt < max_attempts - 1:
-                    time.sleep(random.uniform(1, 3))
-                    continue
-                return {
-                    'success': False,
-                    'error': f'Unexpected error: {str(e)}',
-                    'error_type': 'unexpected_error'
-                }
-        
-        return {
-            'success': False,
-            'error': 'All extraction attempts failed',
-            'error_type': 'max_attempts_exceeded'
-        }
+    async def run(self, func, *args):
+        """Await a blocking backend call on the reader pool"""
+        return await asyncio.get_event_loop().run_in_executor(self._readers, func, *args)
 
-    def download_video_to_temp(self, url, format_id, job_id, content_type=None):
-        """Download video with enhanced cloud compatibility"""
-        temp_dir = None
-        max_attempts = 3
+    async def get_async(self, namespace, key):
+        return await self.run(self.get, namespace, key)
+
+    def set_later(self, namespace, key, value, ttl):
+        """Queue a write on the writer thread without waiting; returns its concurrent Future
         
+        The value is serialised now, so later changes to it are not written.
+        """
+        return self._writer.submit(self._write, namespace, key, json.dumps(value, default=str), ttl)
+
+    def delete(self, namespace, key):
         try:
-            if content_type == 'story':
-                with job_lock:
-                    if job_id in download_jobs:
-                        download_jobs[job_id].update({
-                            'status': 'failed',
-                            'error': 'Stories cannot be downloaded'
-                        })
-                return None
-            
-            with job_lock:
-                if job_id in download_jobs:
-                    download_jobs[job_id]['status'] = 'downloading'
-                    download_jobs[job_id]['progress'] = 5
-            
-            # ✅ CREATE TEMPORARY DIRECTORY
-            temp_dir = tempfile.mkdtemp(prefix='instagram_dl_')
-            unique_id = str(uuid.uuid4())[:8]
-            
-            for attempt in range(max_attempts):
-                try:
-                    # ✅ ADD DELAY BETWEEN DOWNLOAD ATTEMPTS
-                    if attempt > 0:
-                        time.sleep(random.uniform(3, 8))
-                    
-                    download_opts = self.get_random_config(self.download_opts)
-                    
-                    if format_id == 'audio_only':
-                        download_opts.update({
-                            'format': 'bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best',
-                            'outtmpl': os.path.join(temp_dir, f'{unique_id}_%(title)s.%(ext)s'),
-                            'postprocessors': [{
-                                'key': 'FFmpegExtractAudio',
-                                'preferredcodec': 'mp3',
-                                'preferredquality': '320',
-                            }],
-                            'prefer_ffmpeg': True,
-                        })
-                    elif format_id and format_id != 'best':
-                        download_opts.update({
-                            'format': format_id,
-                            'outtmpl': os.path.join(temp_dir, f'{unique_id}_%(title)s.%(ext)s')
-                        })
-                    else:
-                        # ✅ ENHANCED FORMAT SELECTION FOR CLOUD
-                        download_opts.update({
-                            'format': (
-                                'best[height<=1080][acodec!=none]/best[height<=720][acodec!=none]/'
-                                'best[height<=480][acodec!=none]/best[acodec!=none]/'
-                                'bestvideo[height<=1080]+bestaudio/bestvideo[height<=720]+bestaudio/'
-                                'bestvideo+bestaudio/best'
-                            ),
-                            'outtmpl': os.path.join(temp_dir, f'{unique_id}_%(title)s.%(ext)s'),
-                            'merge_output_format': 'mp4',
-                        })
-                    
-                    def progress_hook(d):
-                        try:
-                            if d['status'] == 'downloading':
-                                progress = 50
-                                if '_percent_str' in d:
-                                    percent_str = d['_percent_str'].replace('%', '').strip()
-                                    try:
-                                        progress = float(percent_str)
-                                    except:
-                                        progress = 50
-                                
-                                with job_lock:
-                                    if job_id in download_jobs:
-                                        download_jobs[job_id]['progress'] = min(progress, 95)
-                            
-                            elif d['status'] == 'finished':
-                                with job_lock:
-                                    if job_id in download_jobs:
-                                        download_jobs[job_id]['progress'] = 95
-                                        download_jobs[job_id]['status'] = 'processing'
-                        except Exception:
-                            pass
-                    
-                    download_opts['progress_hooks'] = [progress_hook]
-                    
-                    with yt_dlp.YoutubeDL(download_opts) as ydl:
-                        info = ydl.extract_info(url, download=True)
-                    
-                    # Find the downloaded file
-                    downloaded_files = glob.glob(os.path.join(temp_dir, f'{unique_id}_*'))
-                    if not downloaded_files:
-                        if attempt < max_attempts - 1:
-                            continue
-                        raise Exception("No files were downloaded")
-                    
-                    file_path = downloaded_files[0]
-                    
-                    if not os.path.exists(file_path):
-                        if attempt < max_attempts - 1:
-                            continue
-                        raise Exception("Downloaded file not found")
-                    
-                    file_size = os.path.getsize(file_path)
-                    title = info.get('title', 'Instagram Content')
-                    ext = 'mp3' if format_id == 'audio_only' else info.get('ext', 'mp4')
-                    
-                    # ✅ REGISTER FOR AUTO-CLEANUP
-                    cleanup_time = datetime.now() + timedelta(minutes=5)
-                    with temp_files_lock:
-                        temp_files[job_id] = {
-                            'file_path': file_path,
-                            'temp_dir': temp_dir,
-                            'cleanup_time': cleanup_time,
-                            'filename': os.path.basename(file_path)
-                        }
-                    
-                    with job_lock:
-                        if job_id in download_jobs:
-                            download_jobs[job_id].update({
-                                'status': 'completed',
-                                'progress': 100,
-                                'file_path': file_path,
-                                'filename': os.path.basename(file_path),
-                                'file_size': file_size,
-                                'temp_dir': temp_dir,
-                                'info': {
-                                    'title': title,
-                                    'duration': info.get('duration'),
-                                    'uploader': info.get('uploader'),
-                                    'quality': info.get('height', 'Unknown'),
-                                    'format': info.get('format', 'Unknown')
-                                }
-                            })
-                    
-                    return file_path
-                    
-                except yt_dlp.DownloadError as e:
-                    error_msg = str(e).lower()
-                    if 'rate' in error_msg or 'login' in error_msg:
-                        if attempt < max_attempts - 1:
-                            continue  # Retry with longer delay
-                    raise e
-                except Exception as e:
-                    if attempt < max_attempts - 1:
-                        continue
-                    raise e
-                    
+            self._delete(f'{STATE_KEY_PREFIX}{namespace}:{key}')
         except Exception as e:
-            # ✅ CLEANUP ON ERROR
-            if temp_dir and os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir)
-                except:
-                    pass
-            
-            with job_lock:
-                if job_id in download_jobs:
-                    download_jobs[job_id].update({
-                        'status': 'failed',
-                        'error': f'Download failed: {str(e)}'
-                    })
-            return None
+            self._failed('delete', e)
 
-# ✅ AUTO-CLEANUP BACKGROUND TASK
-async def cleanup_temp_files():
-    """Background task to clean up temporary files"""
-    while True:
+    def take_tokens(self, name, rate, burst, cost):
+        """Refill and draw from a shared token bucket in one atomic step
+        
+        Returns the token level after the draw (negative when the caller must
+        wait), or None if the backend failed.
+        """
         try:
-            current_time = datetime.now()
-            files_to_cleanup = []
-            
-            with temp_files_lock:
-                for job_id, file_info in temp_files.items():
-                    if current_time > file_info['cleanup_time']:
-                        files_to_cleanup.append(job_id)
-            
-            for job_id in files_to_cleanup:
-                with temp_files_lock:
-                    if job_id in temp_files:
-                        file_info = temp_files[job_id]
-                        try:
-                            if os.path.exists(file_info['temp_dir']):
-                                shutil.rmtree(file_info['temp_dir'])
-                        except Exception as e:
-                            print(f"Cleanup error for {job_id}: {e}")
-                        finally:
-                            del temp_files[job_id]
-            
-            await asyncio.sleep(60)  # Check every minute
+            return self._take_tokens(f'{STATE_KEY_PREFIX}bucket:{name}', rate, burst, cost)
         except Exception as e:
-            print(f"Cleanup task error: {e}")
-            await asyncio.sleep(60)
+            self._failed('take_tokens', e)
+            return None
 
-# Async wrappers
-async def extract_info_async(url, content_type=None):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, downloader.extract_info, url, content_type)
+    def purge_expired(self):
+        """Drop expired keys for backends without native expiry"""
+        return 0
 
-async def download_video_async(url, format_id, job_id, content_type=None):
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(executor, downloader.download_video_to_temp, url, format_id, job_id, content_type)
+    def _failed(self, operation, error):
+        self.errors += 1
+        print(f"⚠️ State backend {operation} failed: {error}")
 
-downloader = InstagramDownloader()
+    def stats(self):
+        return {
+            'backend': type(self).__name__,
+            'shared': self.shared,
+            'reads': self.reads,
+            'writes': self.writes,
+            'errors': self.errors
+        }
 
-@app.on_event("startup")
-async def startup_event():
-    """Start background cleanup task"""
-    asyncio.create_task(cleanup_temp_files())
+class MemoryBackend(StateBackend):
+    """Process-local store; the default for a single worker"""
 
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    shared = False
 
-@app.post("/extract")
-async def extract_video_info(request_data: URLRequest):
-    """Extract video information - Enhanced Cloud Support"""
-    try:
-        url = request_data.url.strip()
-        content_type = request_data.content_type
-        original_url = request_data.original_url or url
-        
-        if not url:
-            return JSONResponse(
-                status_code=200,
-                content={
-                    'success': False,
-                    'error': 'Please provide a URL',
-                    'error_type': 'missing_url'
-                }
-            )
-        
-        if not downloader.is_valid_instagram_url(url):
-            return JSONResponse(
-                status_code=200,
-                content={
-                    'success': False,
-                    'error': 'Please provide a valid Instagram URL',
-                    'error_type': 'invalid_url'
-                }
+    def __init__(self):
+        super().__init__()
+        self._entries = {}  # key -> (expires_at, raw)
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def _set(self, key, raw, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, raw)
+
+    def _delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry[0] <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+class SqliteBackend(StateBackend):
+    """SQLite file in WAL mode, shared by workers on one host"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()  # sqlite3 connections are per thread
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # WAL lets readers in other workers proceed while one worker writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM state WHERE key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, raw, ttl):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)', (key, raw, time.time() + ttl)
+        )
+
+    def _delete(self, key):
+        self._connection().execute('DELETE FROM state WHERE key = ?', (key,))
+
+    def _take_tokens(self, key, rate, burst, cost):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')  # Serialises workers on the bucket row
+        try:
+            row = conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+            tokens, updated = json.loads(row[0]) if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate) - cost
+            conn.execute(
+                'INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps([tokens, now]), now + 3600)
             )
-        
-        if not content_type:
-            content_type = downloader.detect_content_type(url)
-        
-        # ✅ STORIES HANDLING
-        if content_type == 'story':
-            return JSONResponse(
-                status_code=200,
-                content={
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return tokens
+
+    def purge_expired(self):
+        try:
+            return self._connection().execute('DELETE FROM state WHERE expires_at <= ?', (time.time(),)).rowcount
+        except sqlite3.Error as e:
+            self._failed('purge', e)
+            return 0
+
+class RedisError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+class RedisBackend(StateBackend):
+    """Minimal RESP client for Redis or anything that speaks its protocol (GET/SET EX/DEL)"""
+
+    def __init__(self, url, timeout=2.0):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.password = parsed.password
+        self.timeout = timeout
+        self._local = threading.local()  # One connection per thread, so no request interleaving
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile('rb'))
+        self._local.conn = conn
+        if self.password:
+            self._command('AUTH', self.password)
+        if self.db:
+            self._command('SELECT', self.db)
+        return conn
+
+    def _command(self, *args):
+        sock, reader = getattr(self._local, 'conn', None) or self._connect()
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        try:
+            sock.sendall(b''.join(parts))
+            return self._read_reply(reader)
+        except (OSError, ConnectionError):
+            # Drop the broken connection; the next command reconnects
+            self._local.conn = None
+            sock.close()
+            raise
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed by Redis server')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RedisError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError('Connection closed by Redis server')
+            return data[:-2]
+        if kind == b'*':
+            count = int(payload)
+            return None if count < 0 else [self._read_reply(reader) for _ in range(count)]
+        raise RedisError(f'Unexpected reply: {line!r}')
+
+    def _get(self, key):
+        raw = self._command('GET', key)
+        return raw.decode() if raw is not None else None
+
+    def _set(self, key, raw, ttl):
+        self._command('SET', key, raw, 'EX', ttl)
+
+    def _delete(self, key):
+        self._command('DEL', key)
+
+    # Runs atomically on the server; state is stored as "tokens:updated"
+    TAKE_TOKENS_SCRIPT = '''
+        local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+        local tokens, updated = burst, now
+        local state = redis.call('GET', KEYS[1])
+        if state then
+            local sep = string.find(state, ':', 1, true)
+            tokens, updated = tonumber(string.sub(state, 1, sep - 1)), tonumber(string.sub(state, sep + 1))
+        end
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - cost
+        redis.call('SET', KEYS[1], tokens .. ':' .. now, 'EX', 3600)
+        return tostring(tokens)
+    '''
+
+    def _take_tokens(self, key, rate, burst, cost):
+        reply = self._command('EVAL', self.TAKE_TOKENS_SCRIPT, 1, key, rate, burst, cost, repr(time.time()))
+        return float(reply)
+
+def create_state_backend(name):
+    if name == 'sqlite':
+        return SqliteBackend(STATE_SQLITE_PATH)
+    if name == 'redis':
+        return RedisBackend(REDIS_URL)
+    if name != 'memory':
+        print(f"⚠️ Unknown STATE_BACKEND '{name}', using memory")
+    return MemoryBackend()
+
+state_backend = create_state_backend(STATE_BACKEND)
+# Stores only write through when sibling workers can read the result
+shared_state = state_backend if state_backend.shared else None
+
+# ✅ PUSH-BASED JOB PROGRESS
+PROGRESS_PUSH_INTERVAL = float(os.environ.get('PROGRESS_PUSH_INTERVAL', 0.5))  # seconds between progress writes
+
+class JobEventHub:
+    """Wakes /events subscribers when a job changes; safe to call from worker threads"""
+
+    def __init__(self):
+        self._loop = None
+        self._subscribers: Dict[str, set] = {}
+
+    def bind(self, loop):
+        self._loop = loop
+
+    def subscribe(self, job_id):
+        # A one-slot queue coalesces bursts of changes into a single wakeup
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        queues = self._subscribers.get(job_id)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[job_id]
+
+    def publish(self, job_id):
+        if self._loop and job_id in self._subscribers:
+            self._loop.call_soon_threadsafe(self._notify, job_id)
+
+    def _notify(self, job_id):
+        for queue in self._subscribers.get(job_id, ()):
+            if queue.empty():
+                queue.put_nowait(True)
+
+    def subscriber_count(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+job_events = JobEventHub()
+
+# ✅ JOB REGISTRY SETTINGS
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 3600))  # finished jobs are evicted after this
+JOB_STATES = ('queued', 'downloading', 'processing', 'completed', 'failed')
+TERMINAL_JOB_STATES = ('completed', 'failed')
+
+class JobRecord:
+    """Fixed-schema download job; __slots__ keeps each record small"""
+
+    FIELDS = (
+        'status', 'progress', 'video_title', 'format_id', 'content_type', 'created_at',
+        'streamable', 'expected_size', 'ext', 'cached',
+        'downloaded_bytes', 'total_bytes', 'speed', 'eta', 'partial_path',
+        'file_path', 'filename', 'file_size', 'temp_dir', 'info', 'error', 'items', 'timings'
+    )
+    INTERNAL_FIELDS = ('partial_path',)
+    __slots__ = FIELDS + ('finished_at',)
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError(f"Unknown job fields: {', '.join(fields)}")
+        self.status = self.status or 'queued'
+        self.progress = self.progress or 0
+        self.finished_at = time.monotonic() if self.status in TERMINAL_JOB_STATES else None
+
+    def to_dict(self, internal=False):
+        """Fields that have been set; internal ones only when asked for"""
+        return {
+            name: getattr(self, name) for name in self.FIELDS
+            if (internal or name not in self.INTERNAL_FIELDS) and getattr(self, name) is not None
+        }
+
+class JobRegistry:
+    """Download jobs behind striped locks, with per-state counts and retention-based eviction
+    
+    With a shared backend every write is queued there, and get_async/fields_async
+    fall back to the copy a sibling worker wrote for jobs this worker does not
+    own. get/fields only see local jobs and never touch the backend.
+    """
+
+    def __init__(self, retention, stripes=16, backend=None):
+        self.retention = retention
+        self.backend = backend
+        self._jobs: Dict[str, JobRecord] = {}
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._index_lock = threading.Lock()  # Guards membership and counts; taken after a stripe
+        self._counts = {state: 0 for state in JOB_STATES}
+        self.evicted = 0
+
+    def _stripe(self, job_id):
+        return self._stripes[hash(job_id) % len(self._stripes)]
+
+    def create(self, job_id, **fields):
+        record = JobRecord(**fields)
+        with self._index_lock:
+            self._jobs[job_id] = record
+            self._counts[record.status] += 1
+        if self.backend:
+            self.backend.set_later('job', job_id, record.to_dict(internal=True), self.retention)
+        return record
+
+    def update(self, job_id, **fields):
+        """Set fields on a job; returns False if the job does not exist"""
+        record = self._jobs.get(job_id)
+        if record is None:
+            return False
+        with self._stripe(job_id):
+            previous = record.status
+            for name, value in fields.items():
+                setattr(record, name, value)
+            if record.status != previous:
+                if record.status in TERMINAL_JOB_STATES:
+                    record.finished_at = time.monotonic()
+                with self._index_lock:
+                    self._counts[previous] -= 1
+                    self._counts[record.status] += 1
+            snapshot = record.to_dict(internal=True) if self.backend else None
+        if snapshot:
+            self.backend.set_later('job', job_id, snapshot, self.retention)
+        return True
+
+    def get(self, job_id):
+        """Snapshot of a local job as a dict, or None"""
+        record = self._jobs.get(job_id)
+        if record is None:
+            return None
+        with self._stripe(job_id):
+            return record.to_dict()
+
+    def fields(self, job_id, *names):
+        """Tuple of selected fields of a local job (internal ones included), or None"""
+        record = self._jobs.get(job_id)
+        if record is None:
+            return None
+        with self._stripe(job_id):
+            return tuple(getattr(record, name) for name in names)
+
+    async def get_async(self, job_id):
+        """Like get, falling back to a sibling worker's copy in the backend"""
+        if job_id in self._jobs or not self.backend:
+            return self.get(job_id)
+        job_data = await self._remote(job_id)
+        if job_data:
+            for name in JobRecord.INTERNAL_FIELDS:
+                job_data.pop(name, None)
+        return job_data
+
+    async def fields_async(self, job_id, *names):
+        """Like fields, falling back to a sibling worker's copy in the backend"""
+        if job_id in self._jobs or not self.backend:
+            return self.fields(job_id, *names)
+        job_data = await self._remote(job_id)
+        return tuple(job_data.get(name) for name in names) if job_data else None
+
+    async def _remote(self, job_id):
+        """A job owned by a sibling worker, as it last wrote it to the backend"""
+        return await self.backend.get_async('job', job_id)
+
+    def __contains__(self, job_id):
+        """True only for jobs this worker owns"""
+        return job_id in self._jobs
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def evict_expired(self):
+        """Drop finished jobs older than the retention window"""
+        cutoff = time.monotonic() - self.retention
+        with self._index_lock:
+            # Terminal jobs never change status again, so reading them here is safe
+            expired = [job_id for job_id, record in self._jobs.items()
+                       if record.finished_at is not None and record.finished_at < cutoff]
+            for job_id in expired:
+                record = self._jobs.pop(job_id)
+                self._counts[record.status] -= 1
+            self.evicted += len(expired)
+        return len(expired)
+
+    def counts(self):
+        with self._index_lock:
+            return dict(self._counts)
+
+download_jobs = JobRegistry(JOB_RETENTION_SECONDS, backend=shared_state)
+
+def update_job(job_id, **fields):
+    """Update a job record and notify anyone streaming its events"""
+    if download_jobs.update(job_id, **fields):
+        job_events.publish(job_id)
+
+# ✅ EXTRACTION CACHE SETTINGS
+EXTRACT_CACHE_TTL = int(os.environ.get('EXTRACT_CACHE_TTL', 600))  # seconds
+EXTRACT_CACHE_MAX_ENTRIES = int(os.environ.get('EXTRACT_CACHE_MAX_ENTRIES', 2048))
+
+SHORTCODE_PATTERN = re.compile(r'instagram\.com/(?:p|reel|reels|tv)/([A-Za-z0-9_-]+)')
+
+def extract_shortcode(url):
+    """Get the canonical post shortcode from an Instagram URL (None if absent)"""
+    match = SHORTCODE_PATTERN.search(url or '')
+    return match.group(1) if match else None
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry and hit/miss counters"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# ✅ SESSION STORE SETTINGS
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 1800))  # seconds
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))
+SESSION_MAX_BYTES = int(os.environ.get('SESSION_MAX_BYTES', 256 * 1024 ** 2))
+
+def approx_size(obj, _seen=None):
+    """Rough deep size in bytes of JSON-like data (dicts, lists, scalars)"""
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(key, seen) + approx_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(approx_size(item, seen) for item in obj)
+    return size
+
+class SessionStore:
+    """Download sessions with per-entry TTL, LRU eviction and approximate memory accounting
+    
+    With a shared backend, new sessions are written through and a local miss is
+    answered from the backend, so any worker can serve a session another created.
+    
+    Objects that several sessions share (the cached info dicts of a post) are
+    passed as shared_parts and charged once, while any session references them.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, backend=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        self.shared_hits = 0
+        self._entries = OrderedDict()  # session_id -> (expires_at, size, data, shared ids)
+        self._shared = {}  # id(obj) -> [sessions referencing it, size, obj]
+        self._dropped = OrderedDict()  # recently expired/evicted ids, to answer session_expired
+        self._lock = threading.Lock()
+        self.approx_bytes = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def put(self, session_id, data, size=None, shared_parts=(), write_through=True):
+        """Store a session; returns the queued backend write's Future when writing through
+        
+        size is the session's own size; shared_parts are (object, size) pairs
+        that are only charged while no other session holds the same object.
+        """
+        write = None
+        if write_through and self.backend:
+            write = self.backend.set_later('session', session_id, data, self.ttl)
+        size = approx_size(data) if size is None else size
+        shared_ids = tuple(id(obj) for obj, _ in shared_parts)
+        with self._lock:
+            if session_id in self._entries:
+                # Replacing (a refresh, or two lookups racing on a sibling's session): uncharge the old entry
+                self._release_locked(session_id)
+            for obj, part_size in shared_parts:
+                shared = self._shared.get(id(obj))
+                if shared is None:
+                    # Holding obj keeps its id from being reused while it is counted
+                    shared = self._shared[id(obj)] = [0, part_size, obj]
+                    self.approx_bytes += part_size
+                shared[0] += 1
+            self._entries[session_id] = (time.monotonic() + self.ttl, size, data, shared_ids)
+            self.approx_bytes += size
+            # Evict least recently used sessions, never the one just stored
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.approx_bytes > self.max_bytes):
+                self._drop_locked(next(iter(self._entries)))
+                self.evictions += 1
+        return write
+
+    async def lookup(self, session_id):
+        """Return (data, None) or (None, 'session_expired' / 'invalid_session')"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._drop_locked(session_id)
+                self.expirations += 1
+                return None, 'session_expired'
+            if entry is not None:
+                self._entries.move_to_end(session_id)
+                return entry[2], None
+            dropped = session_id in self._dropped
+        
+        # Created by a sibling worker (or evicted here first); keep a local copy
+        def load():
+            data = self.backend.get('session', session_id)
+            # Sized on the reader thread too; walking raw_info is too slow for the loop
+            return data, approx_size(data) if data is not None else 0
+        
+        data, size = await self.backend.run(load) if self.backend else (None, 0)
+        if data is not None:
+            self.shared_hits += 1
+            self.put(session_id, data, size, write_through=False)
+            return data, None
+        return None, ('session_expired' if dropped else 'invalid_session')
+
+    def purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [session_id for session_id, entry in self._entries.items() if entry[0] <= now]
+            for session_id in expired:
+                self._drop_locked(session_id)
+            self.expirations += len(expired)
+        return len(expired)
+
+    def _release_locked(self, session_id):
+        """Remove an entry and uncharge it and its shared parts"""
+        _, size, data, shared_ids = self._entries.pop(session_id)
+        self.approx_bytes -= size
+        for shared_id in shared_ids:
+            shared = self._shared[shared_id]
+            shared[0] -= 1
+            if shared[0] == 0:
+                del self._shared[shared_id]
+                self.approx_bytes -= shared[1]
+        return data
+
+    def _drop_locked(self, session_id):
+        data = self._release_locked(session_id)
+        self._dropped[session_id] = True
+        while len(self._dropped) > self.max_entries:
+            self._dropped.popitem(last=False)
+        return session_id, data
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'approx_bytes': self.approx_bytes,
+                'max_bytes': self.max_bytes,
+                'shared_objects': len(self._shared),
+                'ttl': self.ttl,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'shared_hits': self.shared_hits
+            }
+
+video_cache = SessionStore(SESSION_MAX_ENTRIES, SESSION_MAX_BYTES, SESSION_TTL, backend=shared_state)
+
+# Processed /extract results (plus the raw yt-dlp info) keyed by post shortcode
+extract_cache = TTLCache(EXTRACT_CACHE_MAX_ENTRIES, EXTRACT_CACHE_TTL)
+
+# ✅ NEGATIVE CACHE SETTINGS
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.environ.get('NEGATIVE_CACHE_MAX_ENTRIES', 4096))
+NEGATIVE_CACHE_TTLS = {  # seconds per error_type; types not listed are never cached
+    'content_unavailable': int(os.environ.get('NEGATIVE_CACHE_UNAVAILABLE_TTL', 300)),  # private, deleted, not found
+    'extraction_error': int(os.environ.get('NEGATIVE_CACHE_EXTRACTION_ERROR_TTL', 30)),  # failed after every retry
+}
+
+# Failed /extract payloads keyed by post shortcode, so repeats skip yt-dlp entirely
+negative_cache = TTLCache(NEGATIVE_CACHE_MAX_ENTRIES, max(NEGATIVE_CACHE_TTLS.values()))
+negative_cache_hits = {error_type: 0 for error_type in NEGATIVE_CACHE_TTLS}
+
+def negative_cache_snapshot():
+    return {**negative_cache.stats(), 'ttls': NEGATIVE_CACHE_TTLS, 'hits_by_error_type': dict(negative_cache_hits)}
+
+# ✅ DIRECT CDN PROXY SETTINGS
+PROXY_MODE = os.environ.get('PROXY_MODE', 'on') != 'off'
+PROXY_CHUNK_SIZE = 64 * 1024
+PROXY_PASSTHROUGH_HEADERS = ('content-length', 'content-range', 'accept-ranges', 'content-type', 'etag', 'last-modified')
+
+# Pooled keep-alive client for CDN requests (created on startup)
+http_client: Optional[httpx.AsyncClient] = None
+
+# Re-extract when a signed CDN URL has less than this many seconds left
+CDN_URL_EXPIRY_MARGIN = int(os.environ.get('CDN_URL_EXPIRY_MARGIN', 120))
+
+def cdn_urls_expire_at(info):
+    """Earliest expiry (unix time) of the signed CDN URLs in an info dict, if known"""
+    expiries = []
+    info = info or {}
+    for entry in [info, *(entry for entry in info.get('entries') or [] if entry)]:
+        # Carousel images are fetched from their thumbnail URLs, which are signed too
+        for fmt in (entry.get('formats') or []) + (entry.get('thumbnails') or []):
+            # Instagram CDN URLs carry their expiry as hex in the 'oe' parameter
+            oe = parse_qs(urlparse(fmt.get('url') or '').query).get('oe')
+            if oe:
+                try:
+                    expiries.append(int(oe[0], 16))
+                except ValueError:
+                    pass
+    return min(expiries) if expiries else None
+
+def cdn_urls_fresh(info):
+    """True while an info dict's format URLs can still be downloaded directly"""
+    expires_at = cdn_urls_expire_at(info)
+    return expires_at is None or expires_at - time.time() > CDN_URL_EXPIRY_MARGIN
+
+# ✅ MEDIA CACHE SETTINGS
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+MEDIA_CACHE_POLICY = os.environ.get('MEDIA_CACHE_POLICY', 'lru')  # 'lru' or 'lfu'
+
+# ✅ AUDIO FORMATS - 'audio_only' stream-copies the original AAC; MP3 is an explicit opt-in
+AUDIO_FORMATS = {
+    'audio_only': {'codec': 'm4a', 'ext': 'm4a', 'quality': 'Audio Only (Original AAC, M4A)', 'signature': 'm4a-copy'},
+    'audio_mp3': {'codec': 'mp3', 'ext': 'mp3', 'quality': 'Audio Only (320kbps MP3)', 'signature': 'mp3-320', 'bitrate': '320'},
+}
+
+def postprocess_signature(format_id):
+    """Describe the post-processing a format selection implies"""
+    if format_id in AUDIO_FORMATS:
+        return AUDIO_FORMATS[format_id]['signature']
+    if not format_id or format_id == 'best':
+        return 'merge-mp4'
+    return 'none'
+
+def media_cache_key(url, format_id):
+    """Content address of a download: (shortcode, format, post-processing)"""
+    shortcode = extract_shortcode(url)
+    if not shortcode:
+        return None
+    return (shortcode, format_id or 'best', postprocess_signature(format_id))
+
+class MediaCache:
+    """Byte-bounded cache of downloaded files shared between jobs by reference count"""
+
+    def __init__(self, max_bytes, policy='lru'):
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._entries = OrderedDict()  # key -> entry dict, least recently used first
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, key):
+        """Take a reference on a cached file, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+        # Stat without the lock held; a slow disk must not stall every other cache call
+        present = entry is not None and os.path.exists(entry['file_path'])
+        gone = []
+        with self._lock:
+            if entry is None or self._entries.get(key) is not entry:
+                # Never cached, or evicted/replaced while we looked
+                self.misses += 1
+                return None
+            if not present:
+                # Deleted from under us: forget it so its bytes stop counting
+                del self._entries[key]
+                self.total_bytes -= entry['file_size']
+                gone.append(entry['temp_dir'])
+                self.misses += 1
+                entry = None
+            else:
+                entry['refs'] += 1
+                entry['hits'] += 1
+                self._entries.move_to_end(key)
+                self.hits += 1
+                entry = dict(entry)
+        self._remove_dirs(gone)
+        return entry
+
+    def add(self, key, file_path, temp_dir, file_size, info):
+        """Adopt a finished download; the adding job holds the first reference"""
+        with self._lock:
+            if key in self._entries or file_size > self.max_bytes:
+                return False
+            self._entries[key] = {
+                'file_path': file_path,
+                'temp_dir': temp_dir,
+                'filename': os.path.basename(file_path),
+                'file_size': file_size,
+                'info': info,
+                'refs': 1,
+                'hits': 0
+            }
+            self.total_bytes += file_size
+            victims = self._evict_locked()
+        self._remove_dirs(victims)
+        return True
+
+    def release(self, key):
+        """Drop a job's reference; unreferenced files become evictable"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry['refs'] = max(entry['refs'] - 1, 0)
+            victims = self._evict_locked()
+        self._remove_dirs(victims)
+
+    def _evict_locked(self):
+        if self.total_bytes <= self.max_bytes:
+            return []
+        candidates = [key for key, entry in self._entries.items() if entry['refs'] == 0]
+        if self.policy == 'lfu':
+            # Stable sort keeps LRU order between equally popular files
+            candidates.sort(key=lambda key: self._entries[key]['hits'])
+        victims = []
+        for key in candidates:
+            if self.total_bytes <= self.max_bytes:
+                break
+            entry = self._entries.pop(key)
+            self.total_bytes -= entry['file_size']
+            self.evictions += 1
+            victims.append(entry['temp_dir'])
+        return victims
+
+    def _remove_dirs(self, temp_dirs):
+        if temp_dirs:
+            temp_reaper.remove_dirs(temp_dirs)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'policy': self.policy,
+                'referenced': sum(1 for entry in self._entries.values() if entry['refs']),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+media_cache = MediaCache(MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_POLICY)
+
+# Finished files stay servable (resumes, range requests) for this long
+FILE_RETENTION_SECONDS = int(os.environ.get('FILE_RETENTION_SECONDS', 300))
+
+# Expired files that are still streaming get this much longer
+STREAM_GRACE_SECONDS = 30
+TEMP_DIR_PREFIX = 'instagram_dl_'
+
+def make_temp_dir():
+    """Create a download dir tagged with our pid so sibling processes can spot orphans"""
+    return tempfile.mkdtemp(prefix=f'{TEMP_DIR_PREFIX}{os.getpid()}_')
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class TempFileReaper:
+    """Expires temp files in deadline order (min-heap) on a dedicated thread
+    
+    Locks are only held to update bookkeeping; directory deletion always runs
+    on the reaper thread with no lock held, never on the event loop.
+    """
+
+    ORPHAN_PATTERN = re.compile(rf'^{TEMP_DIR_PREFIX}(\d+)_')
+
+    def __init__(self):
+        self._heap = []  # (deadline, seq, job_id)
+        self._removals = deque()  # dirs to delete as soon as possible
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._thread = None
+        self.expired = 0
+        self.dirs_removed = 0
+        self.bytes_reclaimed = 0
+        self.orphans_removed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='temp-file-reaper', daemon=True)
+            self._thread.start()
+
+    def schedule(self, job_id, deadline):
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), job_id))
+            if self._heap[0][2] == job_id:
+                self._cond.notify()
+
+    def remove_dirs(self, temp_dirs):
+        with self._cond:
+            self._removals.extend(temp_dirs)
+            self._cond.notify()
+
+    def _run(self):
+        try:
+            self.sweep_orphans()
+        except Exception as e:
+            print(f"Orphan sweep error: {e}")
+        
+        while True:
+            with self._cond:
+                while not self._removals:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                removals = list(self._removals)
+                self._removals.clear()
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap))
+            
+            for deadline, _, job_id in due:
+                try:
+                    self._expire(job_id, deadline)
+                except Exception as e:
+                    print(f"Cleanup error for {job_id}: {e}")
+            for temp_dir in removals:
+                self._remove_dir(temp_dir)
+
+    def _expire(self, job_id, deadline):
+        with temp_files_lock:
+            file_info = temp_files.get(job_id)
+            if file_info is None or file_info['expires_at'] != deadline:
+                return  # Stale heap entry (file re-registered or already gone)
+            if file_info['active_streams']:
+                file_info['expires_at'] = time.monotonic() + STREAM_GRACE_SECONDS
+                extended = file_info['expires_at']
+            else:
+                extended = None
+                del temp_files[job_id]
+        
+        if extended is not None:
+            self.schedule(job_id, extended)
+            return
+        
+        latency = time.monotonic() - deadline
+        self.expired += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        release_temp_file(file_info)
+
+    def _remove_dir(self, temp_dir):
+        try:
+            if os.path.exists(temp_dir):
+                size = dir_size(temp_dir)
+                shutil.rmtree(temp_dir)
+                self.dirs_removed += 1
+                self.bytes_reclaimed += size
+        except Exception as e:
+            print(f"Cleanup error for {temp_dir}: {e}")
+
+    def sweep_orphans(self):
+        """Remove download dirs left behind by processes that no longer exist"""
+        base = tempfile.gettempdir()
+        cutoff = time.time() - FILE_RETENTION_SECONDS
+        for path in glob.glob(os.path.join(base, f'{TEMP_DIR_PREFIX}*')):
+            match = self.ORPHAN_PATTERN.match(os.path.basename(path))
+            try:
+                if match:
+                    pid = int(match.group(1))
+                    if pid == os.getpid() or pid_alive(pid):
+                        continue
+                elif os.path.getmtime(path) > cutoff:
+                    continue  # Untagged dir from an older build; only reap once it is stale
+            except OSError:
+                continue
+            self._remove_dir(path)
+            self.orphans_removed += 1
+
+    def stats(self):
+        with self._cond:
+            scheduled = len(self._heap)
+            pending_removals = len(self._removals)
+        return {
+            'scheduled': scheduled,
+            'pending_removals': pending_removals,
+            'expired': self.expired,
+            'dirs_removed': self.dirs_removed,
+            'bytes_reclaimed': self.bytes_reclaimed,
+            'orphans_removed': self.orphans_removed,
+            'expiry_latency_avg': round(self.latency_total / self.expired, 3) if self.expired else 0.0,
+            'expiry_latency_max': round(self.latency_max, 3)
+        }
+
+temp_reaper = TempFileReaper()
+
+def register_temp_file(job_id, file_path, temp_dir, cache_key=None):
+    """Track a job's file for auto-cleanup after the retention window"""
+    expires_at = time.monotonic() + FILE_RETENTION_SECONDS
+    with temp_files_lock:
+        temp_files[job_id] = {
+            'file_path': file_path,
+            'temp_dir': temp_dir,
+            'expires_at': expires_at,
+            'filename': os.path.basename(file_path),
+            'cache_key': cache_key,
+            'active_streams': 0
+        }
+    temp_reaper.schedule(job_id, expires_at)
+    if shared_state:
+        # Workers on the same host can serve the file; this worker's reaper still owns it
+        shared_state.set_later('file', job_id, {
+            'file_path': file_path,
+            'temp_dir': temp_dir,
+            'filename': os.path.basename(file_path)
+        }, FILE_RETENTION_SECONDS)
+
+def pin_temp_file(job_id):
+    """Keep a job's file from being cleaned up while a response streams it"""
+    with temp_files_lock:
+        file_info = temp_files.get(job_id)
+        if file_info is None:
+            return None
+        file_info['active_streams'] += 1
+        return dict(file_info)
+
+def unpin_temp_file(job_id):
+    with temp_files_lock:
+        if job_id in temp_files:
+            temp_files[job_id]['active_streams'] -= 1
+
+def expire_temp_file(job_id):
+    """Release a job's file now instead of at the end of its retention window"""
+    now = time.monotonic()
+    with temp_files_lock:
+        file_info = temp_files.get(job_id)
+        if file_info is None:
+            return
+        file_info['expires_at'] = now
+    # The reaper still waits for any other client that is streaming it
+    temp_reaper.schedule(job_id, now)
+
+def release_temp_file(file_info):
+    """Hand a cached file back to the media cache, or delete an uncached one"""
+    if file_info.get('cache_key'):
+        media_cache.release(file_info['cache_key'])
+    else:
+        temp_reaper.remove_dirs([file_info['temp_dir']])
+
+class RetryDownload(Exception):
+    """A download attempt failed in a way that is worth another attempt"""
+
+    def __init__(self, error, delay=None, stale=False, error_type=None):
+        super().__init__(str(error))
+        self.error = error
+        self.delay = random.uniform(3, 8) if delay is None else delay
+        self.stale = stale  # The reused info dict's CDN URLs are no longer valid
+        self.error_type = error_type  # 'rate_limit' / 'authentication_required' feed the circuit breaker
+
+def download_error_type(error_msg):
+    """Classify a lowercased yt-dlp download error the way extract_attempt does"""
+    if 'rate' in error_msg:
+        return 'rate_limit'
+    if 'login' in error_msg:
+        return 'authentication_required'
+    return None
+
+def job_error_type(error):
+    """error_type label for a failed download job or carousel item"""
+    if isinstance(error, PostprocessCancelled):
+        return 'cancelled'
+    if isinstance(error, CircuitOpen):
+        return 'circuit_open'
+    return download_error_type(str(error).lower()) or 'download_error'
+
+# ✅ RETRY SCHEDULER METRICS
+retry_metrics = {
+    stage: {'attempts': 0, 'retries': 0, 'work_seconds': 0.0, 'wait_seconds': 0.0}
+    for stage in ('extract', 'download')
+}
+retry_metrics_lock = threading.Lock()
+
+def record_retry_metric(stage, **amounts):
+    with retry_metrics_lock:
+        for name, amount in amounts.items():
+            retry_metrics[stage][name] += amount
+
+def retry_metrics_snapshot():
+    with retry_metrics_lock:
+        return {stage: {name: round(value, 3) for name, value in values.items()}
+                for stage, values in retry_metrics.items()}
+
+# ✅ POST-PROCESSING METRICS (per postprocess_signature)
+postprocess_metrics: Dict[str, Dict[str, float]] = {}
+postprocess_metrics_lock = threading.Lock()
+
+def record_postprocess(format_id, wall_seconds, cpu_seconds):
+    signature = postprocess_signature(format_id)
+    postprocess_duration.observe(wall_seconds, signature=signature)
+    with postprocess_metrics_lock:
+        metrics = postprocess_metrics.setdefault(
+            signature, {'jobs': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0}
+        )
+        metrics['jobs'] += 1
+        metrics['wall_seconds'] += wall_seconds
+        metrics['cpu_seconds'] += cpu_seconds
+
+def postprocess_metrics_snapshot():
+    with postprocess_metrics_lock:
+        return {
+            signature: {
+                **{name: round(value, 3) for name, value in metrics.items()},
+                'cpu_seconds_per_job': round(metrics['cpu_seconds'] / metrics['jobs'], 3)
+            }
+            for signature, metrics in postprocess_metrics.items()
+        }
+
+# ✅ POST-PROCESSING STAGE SETTINGS
+POSTPROCESS_WORKERS = int(os.environ.get('POSTPROCESS_WORKERS', os.cpu_count() or 1))  # concurrent ffmpeg processes
+POSTPROCESS_TIMEOUT = int(os.environ.get('POSTPROCESS_TIMEOUT', 600))  # seconds before an ffmpeg run is killed
+FFMPEG_BENCH_PATTERN = re.compile(r'bench: utime=([\d.]+)s(?: stime=([\d.]+)s)?')
+
+class PostprocessCancelled(Exception):
+    """The job was cancelled while waiting for or running ffmpeg"""
+
+def postprocess_command(format_id, paths, info):
+    """ffmpeg arguments and output path for a job's raw streams, or None when they need no work"""
+    audio = AUDIO_FORMATS.get(format_id)
+    if audio:
+        source = paths[0]
+        output_path = re.sub(r'_part\d+_', '_', os.path.splitext(source)[0], count=1) + f".{audio['ext']}"
+        if audio['codec'] == 'mp3':
+            codec_args = ['-c:a', 'libmp3lame', '-b:a', f"{audio['bitrate']}k"]
+        elif (info.get('acodec') or '').startswith(('mp4a', 'aac')):
+            codec_args = ['-c:a', 'copy']  # AAC into m4a is a stream copy, no decode
+        else:
+            codec_args = ['-c:a', 'aac']
+        return ['-y', '-i', source, '-vn', *codec_args, output_path], output_path
+    
+    if len(paths) > 1:
+        # Separate video and audio streams: mux into one mp4 without re-encoding
+        output_path = re.sub(r'_part\d+_', '_', os.path.splitext(paths[0])[0], count=1) + '.mp4'
+        inputs = [arg for path in paths for arg in ('-i', path)]
+        maps = [arg for number in range(len(paths)) for arg in ('-map', str(number))]
+        return ['-y', *inputs, *maps, '-c', 'copy', '-movflags', '+faststart', output_path], output_path
+    
+    return None
+
+class PostprocessStage:
+    """Bounded ffmpeg stage that runs after the download, off the download workers
+    
+    Muxing and transcoding run as ffmpeg subprocesses, at most `workers` at a
+    time; jobs beyond that wait in the stage's own queue. Download workers
+    only await the result, so one slow transcode no longer holds a yt-dlp
+    thread. Lives on the event loop; every method must be called from it.
+    """
+
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = None  # Created on first use, inside the running loop
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.cpu_seconds = 0.0
+
+    async def run(self, job_id, args):
+        """Run ffmpeg with args for a job; returns {'wait', 'run', 'cpu'} seconds
+        
+        Raises PostprocessCancelled when cancel(job_id) is called meanwhile;
+        only the inner task is cancelled, never the caller. If the caller is
+        cancelled, ffmpeg is stopped too.
+        """
+        task = asyncio.ensure_future(self._execute(args))
+        self._tasks[job_id] = task
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            # The caller itself was cancelled: stop ffmpeg and free its slot before unwinding
+            task.cancel()
+            await asyncio.wait([task])
+            self.cancelled += 1
+            raise
+        finally:
+            self._tasks.pop(job_id, None)
+        if task.cancelled():
+            self.cancelled += 1
+            raise PostprocessCancelled("Cancelled")
+        return task.result()
+
+    def cancel(self, job_id):
+        """Cancel a job waiting for or running ffmpeg; False if it is not in the stage"""
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    def __contains__(self, job_id):
+        return job_id in self._tasks
+
+    async def _execute(self, args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        
+        queued_at = time.monotonic()
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        wait = time.monotonic() - queued_at
+        self.wait_seconds += wait
+        
+        self.active += 1
+        started = time.monotonic()
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-hide_banner', '-nostdin', '-nostats', '-benchmark', *args,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                raise Exception(f"ffmpeg timed out after {self.timeout}s")
+            
+            stderr = stderr.decode('utf-8', 'replace')
+            if process.returncode != 0:
+                lines = [line for line in stderr.strip().splitlines() if line.strip()]
+                raise Exception(f"ffmpeg failed: {lines[-1] if lines else process.returncode}")
+            
+            # -benchmark reports ffmpeg's own user/system CPU time
+            bench = FFMPEG_BENCH_PATTERN.search(stderr)
+            cpu = sum(float(value) for value in bench.groups() if value) if bench else 0.0
+            run = time.monotonic() - started
+            self.completed += 1
+            self.run_seconds += run
+            self.cpu_seconds += cpu
+            return {'wait': wait, 'run': run, 'cpu': cpu}
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            if process is not None and process.returncode is None:
+                process.kill()  # Cancelled or timed out
+                await asyncio.shield(process.wait())
+            self.active -= 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queued': self.queued,
+            'active': self.active,
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'wait_seconds': round(self.wait_seconds, 3),
+            'run_seconds': round(self.run_seconds, 3),
+            'cpu_seconds': round(self.cpu_seconds, 3)
+        }
+
+postprocess_stage = PostprocessStage(POSTPROCESS_WORKERS, POSTPROCESS_TIMEOUT)
+
+# ✅ ENHANCED FORMAT SELECTION FOR CLOUD
+BEST_FORMAT_SELECTOR = (
+    'best[height<=1080][acodec!=none]/best[height<=720][acodec!=none]/'
+    'best[height<=480][acodec!=none]/best[acodec!=none]/'
+    'bestvideo[height<=1080]+bestaudio/bestvideo[height<=720]+bestaudio/'
+    'bestvideo+bestaudio/best'
+)
+
+class InstagramDownloader:
+    def __init__(self):
+        # ✅ ENHANCED USER AGENTS FOR CLOUD DEPLOYMENT
+        self.user_agents = [
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0'
+        ]
+        
+        # ✅ ENHANCED HEADERS TO MIMIC REAL BROWSER
+        self.headers = {
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.9',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'DNT': '1',
+            'Connection': 'keep-alive',
+            'Upgrade-Insecure-Requests': '1',
+            'Sec-Fetch-Dest': 'document',
+            'Sec-Fetch-Mode': 'navigate',
+            'Sec-Fetch-Site': 'none',
+            'Sec-Fetch-User': '?1',
+            'Cache-Control': 'max-age=0',
+        }
+        
+        self.extract_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            'extract_flat': False,
+            'writesubtitles': False,
+            'writeautomaticsub': False,
+            'socket_timeout': 45,  # Increased timeout
+            'retries': 5,  # More retries
+            'user_agent': random.choice(self.user_agents),
+            # ✅ ENHANCED BYPASS OPTIONS (pacing is done by rate_governor, not sleeps)
+            'http_headers': self.headers,
+            'ignoreerrors': False,
+            'ignore_no_formats_error': True,  # Keep image posts/items; extract_attempt rejects videos without formats
+            'no_check_certificate': True,
+            # ✅ INSTAGRAM SPECIFIC OPTIONS
+            'extractor_args': {
+                'instagram': {
+                    'api_version': 'v1',
+                    'include_stories': False
+                }
+            }
+        }
+        
+        # ✅ ENHANCED DOWNLOAD OPTIONS FOR CLOUD
+        self.download_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extractaudio': False,
+            'writesubtitles': False,
+            'writeautomaticsub': False,
+            'socket_timeout': 60,
+            'retries': 8,  # Even more retries for download
+            'user_agent': random.choice(self.user_agents),
+            'http_headers': self.headers,
+            'no_check_certificate': True,
+            'prefer_insecure': False,
+            # ✅ QUALITY SETTINGS
+            'format_sort': ['res:1080', 'fps', 'hdr:12', 'codec:h264', 'size', 'br', 'asr'],
+            'format_sort_force': True,
+            # ✅ INSTAGRAM SPECIFIC BYPASS
+            'extractor_args': {
+                'instagram': {
+                    'api_version': 'v1',
+                    'include_stories': False,
+                    'comment_count': 0,
+                    'like_count': 0
+                }
+            }
+        }
+
+    def get_random_config(self, base_opts):
+        """Get randomized config to avoid detection"""
+        config = base_opts.copy()
+        config['user_agent'] = random.choice(self.user_agents)
+        config['socket_timeout'] = random.randint(30, 60)
+        return config
+
+    def is_valid_instagram_url(self, url):
+        """Check if URL is valid Instagram URL"""
+        patterns = [
+            r'https?://(?:www\.)?instagram\.com/p/[A-Za-z0-9_-]+',
+            r'https?://(?:www\.)?instagram\.com/reel/[A-Za-z0-9_-]+',
+            r'https?://(?:www\.)?instagram\.com/reels/[A-Za-z0-9_-]+',
+            r'https?://(?:www\.)?instagram\.com/tv/[A-Za-z0-9_-]+',
+            r'https?://(?:www\.)?instagram\.com/stories/[A-Za-z0-9_.-]+/[0-9]+',
+        ]
+        
+        for pattern in patterns:
+            if re.match(pattern, url):
+                return True
+        return False
+
+    def detect_content_type(self, url):
+        """Detect content type from URL"""
+        if '/stories/' in url:
+            return 'story'
+        elif '/reels/' in url or '/reel/' in url:
+            return 'reel'
+        elif '/p/' in url:
+            return 'post'
+        elif '/tv/' in url:
+            return 'igtv'
+        return 'unknown'
+
+    def extract_attempt(self, url, content_type=None, attempt=0, max_attempts=3):
+        """Run a single extraction attempt with enhanced error handling
+        
+        Never sleeps: when another attempt is worthwhile the result carries a
+        'retry_delay' and the caller schedules it on the event loop.
+        """
+        can_retry = attempt < max_attempts - 1
+        # ✅ DELAY BEFORE THE NEXT ATTEMPT (WAITED OUT OFF THE THREAD POOL)
+        retry_delay = random.uniform(2, 5)
+        
+        # ✅ Handle stories immediately
+        if content_type == 'story':
+            return {
+                'success': False,
+                'error': 'Instagram Stories are not supported',
+                'error_type': 'story_not_supported',
+                'message': 'Stories cannot be downloaded due to Instagram restrictions'
+            }
+        
+        try:
+            # Get randomized config for this attempt
+            extract_opts = self.get_random_config(self.extract_opts)
+            
+            with yt_dlp.YoutubeDL(extract_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+            
+            # ignore_no_formats_error only exists for image items; a video without formats is still an error
+            if info.get('_type') != 'playlist' and not info.get('formats') and not is_image_post(info):
+                raise yt_dlp.DownloadError('No video formats found')
+                
+            return {
+                'success': True,
+                'data': info,
+                'content_type': content_type
+            }
+            
+        except yt_dlp.DownloadError as e:
+            error_msg = str(e).lower()
+            
+            # ✅ ENHANCED ERROR DETECTION
+            if any(keyword in error_msg for keyword in ['login', 'cookies', 'authentication', 'sign in']):
+                return {
                     'success': False,
-                    'error': 'Instagram Stories Not Supported',
-                    'error_type': 'story_not_supported',
-                    'message': 'Instagram Stories cannot be downloaded due to platform restrictions.',
-                    'details': {
-                        'reasons': [
-                            'Stories require Instagram login and authentication',
-                            'Stories expire after 24 hours',
-                            'Most stories are private or restricted',
-                            'Instagram has strict anti-scraping measures'
-                        ],
-                        'alternatives': [
-                            'Try downloading Instagram Reels instead',
-                            'Use Instagram Posts (they work reliably)',
-                            'Check if the content is available as a Reel'
-                        ]
-                    },
-                    'recommendation': 'Please try using Instagram Reels or Posts instead!'
+                    'error': 'This content requires authentication or is rate-limited',
+                    'error_type': 'authentication_required',
+                    'suggestion': 'Try again in a few minutes or use a different post',
+                    **({'retry_delay': retry_delay} if can_retry else {})  # Retry with different config
                 }
-            )
-        
-        # Extract info for other content
-        result = await extract_info_async(url, content_type)
-        
-        if not result['success']:
-            return JSONResponse(
-                status_code=200,
-                content={
+            elif any(keyword in error_msg for keyword in ['private', 'unavailable', 'not found']):
+                return {
+                    'success': False,
+                    'error': 'Content is private or unavailable',
+                    'error_type': 'content_unavailable'
+                }
+            elif 'rate' in error_msg:
+                return {
+                    'success': False,
+                    'error': 'Rate limit reached. Please try again later.',
+                    'error_type': 'rate_limit',
+                    # Longer wait for rate limit
+                    **({'retry_delay': retry_delay + random.uniform(5, 10)} if can_retry else {})
+                }
+            else:
+                return {
                     'success': False,
-                    'error': result['error'],
-                    'error_type': result.get('error_type', 'unknown'),
-                    'suggestion': result.get('suggestion', 'Try using a different public Instagram post or reel.')
+                    'error': f'Extraction failed: {str(e)}',
+                    'error_type': 'extraction_error',
+                    **({'retry_delay': retry_delay} if can_retry else {})
                 }
+                
+        except Exception as e:
+            return {
+                'success': False,
+                'error': f'Unexpected error: {str(e)}',
+                'error_type': 'unexpected_error',
+                **({'retry_delay': retry_delay + random.uniform(1, 3)} if can_retry else {})
+            }
+
+    def prepare_download(self, job_id, content_type=None):
+        """Mark a job as downloading and give it a temp dir (None for stories)"""
+        if content_type == 'story':
+            update_job(job_id, status='failed', error='Stories cannot be downloaded')
+            return None
+        
+        update_job(job_id, status='downloading', progress=5)
+        
+        # ✅ CREATE TEMPORARY DIRECTORY
+        return make_temp_dir()
+
+    def fetch_streams(self, download_opts, temp_dir, prefix, url=None, info=None, split=False):
+        """Download each stream a format selection picks, one yt-dlp pass per stream
+        
+        yt-dlp would mux or convert them with ffmpeg on this worker thread;
+        instead the raw streams are returned for the post-processing stage.
+        Streams are named '<prefix>_part<n>_...' when there are several (or
+        split is set), so the final file can take the plain '<prefix>_...' name.
+        Returns (file paths, resolved info dict).
+        """
+        download_opts = dict(download_opts, fixup='never')  # Container fixes happen in the post-processing stage
+        with yt_dlp.YoutubeDL(download_opts) as ydl:
+            if not info:
+                info = ydl.extract_info(url, download=False)
+            # ✅ SKIP RE-EXTRACTION - RESOLVE THE FORMAT SELECTION ON THE /extract INFO DICT
+            resolved = ydl.process_ie_result(yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True), download=False)
+        
+        streams = resolved.get('requested_formats') or [resolved]
+        split = split or len(streams) > 1
+        paths = []
+        for number, stream in enumerate(streams):
+            stream_prefix = f'{prefix}_part{number}' if split else prefix
+            stream_opts = dict(
+                download_opts,
+                format=stream['format_id'],
+                outtmpl=os.path.join(temp_dir, f'{stream_prefix}_%(title)s.%(ext)s')
             )
+            with yt_dlp.YoutubeDL(stream_opts) as ydl:
+                ydl.process_ie_result(yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True), download=True)
+            
+            downloaded_files = [
+                path for path in glob.glob(os.path.join(temp_dir, f'{stream_prefix}_*'))
+                if not path.endswith(('.part', '.ytdl'))
+                and (split or not re.match(rf'{prefix}_part\d+_', os.path.basename(path)))
+            ]
+            if not downloaded_files:
+                raise RetryDownload(Exception("No files were downloaded"))
+            paths.append(downloaded_files[0])
+        return paths, resolved
+
+    def download_attempt(self, url, format_id, job_id, temp_dir, content_type=None, info=None, streamable=False):
+        """Run a single download attempt into temp_dir with enhanced cloud compatibility
         
-        info = result['data']
+        When the info dict from /extract is passed in, yt-dlp skips extraction
+        and starts with the media request. Retryable failures raise
+        RetryDownload instead of sleeping on the worker thread. Returns
+        (file paths, info): several paths when the streams still need muxing.
+        """
+        # One prefix per job so every attempt writes (and resumes) the same file
+        unique_id = job_id[:8]
         
-        # ✅ ENHANCED FORMAT PROCESSING FOR HIGHEST QUALITY
-        formats = []
-        if 'formats' in info and info['formats']:
-            # Filter and sort for highest quality video formats
-            video_formats = []
+        try:
+            download_opts = self.get_random_config(self.download_opts)
             
-            for fmt in info['formats']:
-                if (fmt.get('vcodec') != 'none' and
-                     fmt.get('acodec') != 'none' and
-                     fmt.get('height') and fmt.get('width')):
-                    
-                    # ✅ SAFE QUALITY SCORE CALCULATION WITH NONE CHECKS
-                    height = fmt.get('height') or 0
-                    width = fmt.get('width') or 0
-                    tbr = fmt.get('tbr') or 0
+            if format_id in AUDIO_FORMATS:
+                # Fetched as-is; the audio is extracted by the post-processing stage
+                download_opts['format'] = 'bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best'
+            elif format_id and format_id != 'best':
+                download_opts['format'] = format_id
+            else:
+                download_opts['format'] = BEST_FORMAT_SELECTOR
+            
+            last_push = [0.0]
+            
+            def progress_hook(d):
+                try:
+                    if d['status'] == 'downloading':
+                        # ✅ COALESCE PROGRESS - AT MOST ONE WRITE PER INTERVAL
+                        now = time.monotonic()
+                        if now - last_push[0] < PROGRESS_PUSH_INTERVAL:
+                            return
+                        last_push[0] = now
+                        
+                        progress = 50
+                        if '_percent_str' in d:
+                            percent_str = d['_percent_str'].replace('%', '').strip()
+                            try:
+                                progress = float(percent_str)
+                            except:
+                                progress = 50
+                        
+                        update_job(
+                            job_id,
+                            progress=min(progress, 95),
+                            downloaded_bytes=d.get('downloaded_bytes'),
+                            total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+                            speed=d.get('speed'),
+                            eta=d.get('eta'),
+                            # The first callback publishes the .part path for tee readers
+                            **({'partial_path': d.get('tmpfilename')} if streamable else {})
+                        )
                     
-                    # Ensure all values are numbers
+                    elif d['status'] == 'finished' and streamable:
+                        # Tells tee readers the writer is done
+                        update_job(job_id, progress=95, status='processing')
+                except Exception:
+                    pass
+            
+            download_opts['progress_hooks'] = [progress_hook]
+            
+            return self.fetch_streams(
+                download_opts, temp_dir, unique_id, url, info,
+                split=format_id in AUDIO_FORMATS
+            )
+            
+        except RetryDownload:
+            raise
+        except yt_dlp.DownloadError as e:
+            error_msg = str(e).lower()
+            if info and any(keyword in error_msg for keyword in ['403', '410', 'forbidden', 'expired']):
+                raise RetryDownload(e, delay=0, stale=True)  # Signed CDN URL went stale, re-extract
+            error_type = download_error_type(error_msg)
+            if error_type:
+                raise RetryDownload(e, error_type=error_type)  # Retry with longer delay
+            raise e
+        except Exception as e:
+            raise RetryDownload(e)
+
+    def complete_download(self, job_id, url, format_id, temp_dir, file_path, info, timings):
+        """Cache and register a finished file and mark the job completed"""
+        file_size = os.path.getsize(file_path)
+        title = info.get('title', 'Instagram Content')
+        job_info = {
+            'title': title,
+            'duration': info.get('duration'),
+            'uploader': info.get('uploader'),
+            'quality': info.get('height', 'Unknown'),
+            'format': info.get('format', 'Unknown')
+        }
+        
+        # ✅ SHARE WITH LATER JOBS FOR THE SAME POST/FORMAT
+        cache_key = media_cache_key(url, format_id)
+        if cache_key and not media_cache.add(cache_key, file_path, temp_dir, file_size, job_info):
+            cache_key = None
+        
+        # ✅ REGISTER FOR AUTO-CLEANUP
+        register_temp_file(job_id, file_path, temp_dir, cache_key)
+        
+        update_job(
+            job_id,
+            status='completed',
+            progress=100,
+            file_path=file_path,
+            filename=os.path.basename(file_path),
+            file_size=file_size,
+            temp_dir=temp_dir,
+            info=job_info,
+            timings=timings
+        )
+        
+        return file_path
+
+    def download_item(self, entry, temp_dir, index, on_progress):
+        """Download one carousel video's streams from its info dict; returns (file paths, info)"""
+        download_opts = self.get_random_config(self.download_opts)
+        download_opts['format'] = BEST_FORMAT_SELECTOR
+        
+        def progress_hook(d):
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if d['status'] == 'downloading' and total:
+                on_progress(min(100 * (d.get('downloaded_bytes') or 0) / total, 95))
+        
+        download_opts['progress_hooks'] = [progress_hook]
+        
+        try:
+            return self.fetch_streams(download_opts, temp_dir, f'{index:02d}', info=entry)
+        except yt_dlp.DownloadError as e:
+            raise RetryDownload(e, error_type=download_error_type(str(e).lower()))
+
+    def fail_download(self, job_id, temp_dir, error):
+        """Mark a job as failed and remove its temp dir"""
+        # ✅ CLEANUP ON ERROR (deleted on the reaper thread)
+        if temp_dir:
+            temp_reaper.remove_dirs([temp_dir])
+        
+        update_job(job_id, status='failed', error=f'Download failed: {str(error)}')
+        errors_total.inc(stage='download', error_type=job_error_type(error))
+
+# ✅ AUTO-CLEANUP BACKGROUND TASK (temp files are handled by temp_reaper)
+async def cleanup_expired_state():
+    """Background task to drop expired sessions and finished jobs"""
+    while True:
+        try:
+            video_cache.purge_expired()
+            download_jobs.evict_expired()
+            await state_backend.run(state_backend.purge_expired)
+        except Exception as e:
+            print(f"Cleanup task error: {e}")
+        await asyncio.sleep(60)  # Check every minute
+
+# ✅ IN-FLIGHT EXTRACTION COALESCING (event loop only, no lock needed)
+inflight_extractions: Dict[str, asyncio.Future] = {}
+inflight_waiters: Dict[str, int] = {}
+coalesce_stats = {'leaders': 0, 'coalesced': 0, 'max_waiters': 0}
+
+def coalescing_snapshot():
+    """Waiter counts for extractions currently in flight plus lifetime totals"""
+    return {
+        'in_flight': dict(inflight_waiters),
+        **coalesce_stats
+    }
+
+# ✅ NON-BLOCKING RETRIES: ATTEMPTS RUN ON THE POOL, BACKOFF WAITS ON THE EVENT LOOP
+# ✅ CIRCUIT BREAKER SETTINGS
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))  # consecutive failures that open it
+CIRCUIT_COOLDOWN = int(os.environ.get('CIRCUIT_COOLDOWN', 60))  # seconds before the first probe
+CIRCUIT_MAX_COOLDOWN = int(os.environ.get('CIRCUIT_MAX_COOLDOWN', 900))
+CIRCUIT_TRIP_ERRORS = ('rate_limit', 'authentication_required')
+
+class CircuitOpen(Exception):
+    """Raised instead of calling Instagram while the circuit breaker is open"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Instagram is rate limiting requests, retry in {retry_after}s')
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Stops calling Instagram after repeated rate-limit or login failures
+    
+    closed: calls go through; consecutive trip errors are counted.
+    open: calls fail fast until the cooldown ends.
+    half_open: a single probe goes through. Any other outcome closes the
+    circuit; another trip error re-opens it with a doubled cooldown.
+    """
+
+    def __init__(self, threshold, cooldown, max_cooldown):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_at = None
+        self._lock = threading.Lock()  # Outcomes are recorded from worker threads
+        self.opened = 0
+        self.rejected = 0
+        self.probes = 0
+
+    def _retry_after_locked(self, now):
+        if self.state == 'open':
+            return max(1, math.ceil(self._opened_at + self.cooldown - now))
+        if self.state == 'half_open' and self._probe_at is not None and now - self._probe_at <= self.base_cooldown:
+            return 1  # Waiting on the probe
+        return 0
+
+    def retry_after(self):
+        """Seconds until calls are let through again (0 when they are now)"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open' and now >= self._opened_at + self.cooldown:
+                return 0  # The next call becomes the probe
+            return self._retry_after_locked(now)
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open' and now >= self._opened_at + self.cooldown:
+                self.state = 'half_open'
+                self._probe_at = None
+            if self.state == 'closed':
+                return True
+            # A probe that never reported back (stuck or lost) is replaced after one cooldown
+            if self.state == 'half_open' and self._retry_after_locked(now) == 0:
+                self._probe_at = now
+                self.probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, error_type):
+        """Feed back the outcome of a call (its error_type, None on success)"""
+        with self._lock:
+            if error_type in CIRCUIT_TRIP_ERRORS:
+                self.failures += 1
+                if self.state == 'half_open':
+                    self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                    self._open()
+                elif self.state == 'closed' and self.failures >= self.threshold:
+                    self._open()
+            elif self.state != 'open':
+                if self.state == 'half_open':
+                    print("✅ Circuit closed - Instagram is answering again")
+                self.state = 'closed'
+                self.failures = 0
+                self.cooldown = self.base_cooldown
+
+    def _open(self):
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+        self._probe_at = None
+        self.opened += 1
+        print(f"⚠️ Circuit opened after {self.failures} rate-limit/login failures, cooling down {self.cooldown}s")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'cooldown': self.cooldown,
+                'retry_after': self._retry_after_locked(time.monotonic()),
+                'opened': self.opened,
+                'rejected': self.rejected,
+                'probes': self.probes
+            }
+
+circuit_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN, CIRCUIT_MAX_COOLDOWN)
+
+def circuit_open_result(retry_after):
+    """The rate_limit failure returned without calling Instagram"""
+    return {
+        'success': False,
+        'error': 'Instagram is rate limiting requests. Please try again later.',
+        'error_type': 'rate_limit',
+        'suggestion': f'Try again in {retry_after} seconds.',
+        'retry_after': retry_after
+    }
+
+# ✅ OUTBOUND RATE GOVERNOR SETTINGS
+INSTAGRAM_RATE = float(os.environ.get('INSTAGRAM_RATE', 1.0))  # requests per second; 0 disables the governor
+INSTAGRAM_BURST = int(os.environ.get('INSTAGRAM_BURST', 10))
+RATE_GOVERNOR_SHARED = os.environ.get('RATE_GOVERNOR_SHARED', 'off') == 'on'  # one budget across workers
+
+class RateGovernor:
+    """Token bucket pacing outbound Instagram requests
+    
+    A token is reserved on the event loop before each request and the caller
+    only sleeps when the bucket is empty. Reservations may drive the level
+    negative, so concurrent callers are spaced out in arrival order instead of
+    all waking at once. With a shared backend every worker draws from one bucket;
+    the draw runs on the backend's reader pool, never on the loop itself.
+    """
+
+    def __init__(self, rate, burst, backend=None):
+        self.rate = rate
+        self.burst = burst
+        self.backend = backend
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._shared_level = None  # (tokens, monotonic time) seen at the last shared draw
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _take_local(self, cost):
+        """Token level of this worker's bucket after drawing cost tokens"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate) - cost
+            self._updated = now
+            return self._tokens
+
+    async def reserve(self, cost=1):
+        """Take tokens now; returns the seconds to wait before using them"""
+        if self.rate <= 0:
+            return 0.0
+        tokens = None
+        if self.backend:
+            tokens = await self.backend.run(self.backend.take_tokens, 'instagram', self.rate, self.burst, cost)
+            if tokens is not None:
+                self._shared_level = (tokens, time.monotonic())
+        if tokens is None:
+            # Not shared, or the backend is unavailable - pace this worker on its own
+            tokens = self._take_local(cost)
+        return max(0.0, -tokens / self.rate)
+
+    def level(self):
+        """Current token level, projected from the last draw without taking or writing anything"""
+        with self._lock:
+            tokens, updated = self._shared_level if self.backend and self._shared_level else (self._tokens, self._updated)
+        return min(self.burst, tokens + (time.monotonic() - updated) * self.rate)
+
+    async def acquire(self, cost=1):
+        delay = await self.reserve(cost)
+        self.acquired += 1
+        if delay > 0:
+            self.delayed += 1
+            self.wait_total += delay
+            self.wait_max = max(self.wait_max, delay)
+            await asyncio.sleep(delay)
+        return delay
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'shared': self.backend is not None,
+            'tokens': round(self.level(), 3) if self.rate > 0 else None,  # Shared: as of this worker's last draw
+            'acquired': self.acquired,
+            'delayed': self.delayed,
+            'wait_seconds_total': round(self.wait_total, 3),
+            'wait_seconds_avg': round(self.wait_total / self.delayed, 3) if self.delayed else 0.0,
+            'wait_seconds_max': round(self.wait_max, 3)
+        }
+
+rate_governor = RateGovernor(INSTAGRAM_RATE, INSTAGRAM_BURST, shared_state if RATE_GOVERNOR_SHARED else None)
+
+async def run_attempt(stage, func, *args):
+    """Run one attempt on the executor, counting only its in-thread time as work"""
+    if not circuit_breaker.allow():
+        raise CircuitOpen(circuit_breaker.retry_after())
+    # Every attempt talks to Instagram, so it waits for the rate budget first
+    await rate_governor.acquire()
+    
+    def timed():
+        started = time.monotonic()
+        error_type = None
+        try:
+            result = func(*args)
+            if isinstance(result, dict) and not result.get('success', True):
+                error_type = result.get('error_type')
+            return result
+        except RetryDownload as retry:
+            error_type = retry.error_type
+            raise
+        finally:
+            # Recorded on the worker thread, so a cancelled caller cannot lose a probe result
+            circuit_breaker.record(error_type)
+            elapsed = time.monotonic() - started
+            record_retry_metric(stage, attempts=1, work_seconds=elapsed)
+            ytdlp_attempt_duration.observe(elapsed, stage=stage)
+    
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, timed)
+
+async def backoff(stage, delay):
+    """Wait before a retry without holding a worker thread"""
+    record_retry_metric(stage, retries=1, wait_seconds=delay)
+    await asyncio.sleep(delay)
+
+async def extract_with_retries(url, content_type=None, max_attempts=3):
+    for attempt in range(max_attempts):
+        try:
+            result = await run_attempt('extract', downloader.extract_attempt, url, content_type, attempt, max_attempts)
+        except CircuitOpen as e:
+            return circuit_open_result(e.retry_after)
+        retry_delay = result.pop('retry_delay', None)
+        if retry_delay is None:
+            return result
+        retry_after = circuit_breaker.retry_after()
+        if retry_after:
+            # This failure opened the circuit - retrying now would only be rejected
+            return {**result, 'retry_after': retry_after}
+        await backoff('extract', retry_delay)
+    return result
+
+# Async wrappers
+async def extract_info_async(url, content_type=None):
+    """Run one extraction per post; concurrent callers share the same future"""
+    key = extract_shortcode(url) or url
+    
+    pending = inflight_extractions.get(key)
+    if pending is not None:
+        inflight_waiters[key] += 1
+        coalesce_stats['coalesced'] += 1
+        return await asyncio.shield(pending)
+    
+    future = asyncio.ensure_future(extract_with_retries(url, content_type))
+    inflight_extractions[key] = future
+    inflight_waiters[key] = 0
+    coalesce_stats['leaders'] += 1
+    
+    def finished(_):
+        inflight_extractions.pop(key, None)
+        waiters = inflight_waiters.pop(key, 0)
+        coalesce_stats['max_waiters'] = max(coalesce_stats['max_waiters'], waiters)
+    
+    future.add_done_callback(finished)
+    # Shield so a disconnecting first caller does not cancel it for the others
+    return await asyncio.shield(future)
+
+async def postprocess_download(job_id, format_id, paths, info, label=None):
+    """Send a job's raw streams through postprocess_stage; returns (file path, stage timings)
+    
+    label is the stage id the job is cancellable under (defaults to job_id).
+    """
+    command = postprocess_command(format_id, paths, info)
+    if command is None:
+        return paths[0], {'wait': 0.0, 'run': 0.0, 'cpu': 0.0}
+    args, output_path = command
+    stage_timings = await postprocess_stage.run(label or job_id, args)
+    for path in paths:
+        try:
+            os.remove(path)  # Raw streams are no longer needed
+        except OSError:
+            pass
+    record_postprocess(format_id, stage_timings['run'], stage_timings['cpu'])
+    return output_path, stage_timings
+
+async def download_video_async(url, format_id, job_id, content_type=None, info=None, streamable=False, max_attempts=3):
+    created_at = (download_jobs.fields(job_id, 'created_at') or [None])[0]
+    queue_wait = (datetime.now() - datetime.fromisoformat(created_at)).total_seconds() if created_at else 0.0
+    
+    temp_dir = downloader.prepare_download(job_id, content_type)
+    if not temp_dir:
+        return None
+    
+    queue_wait_duration.observe(queue_wait)
+    
+    reuse_info = info if info and cdn_urls_fresh(info) else None
+    try:
+        started = time.monotonic()
+        for attempt in range(max_attempts):
+            try:
+                paths, result_info = await run_attempt(
+                    'download', downloader.download_attempt,
+                    url, format_id, job_id, temp_dir, content_type, reuse_info, streamable
+                )
+                break
+            except RetryDownload as retry:
+                if attempt == max_attempts - 1 or circuit_breaker.retry_after():
+                    raise retry.error
+                if retry.stale:
+                    reuse_info = None
+                await backoff('download', retry.delay)
+        download_seconds = time.monotonic() - started
+        download_duration.observe(download_seconds)
+        
+        # ✅ FFMPEG RUNS IN ITS OWN STAGE, THE DOWNLOAD THREAD IS ALREADY FREE
+        update_job(job_id, progress=95, status='processing')
+        file_path, stage_timings = await postprocess_download(job_id, format_id, paths, result_info)
+        
+        timings = {
+            'queue_wait': round(queue_wait, 3),
+            'download': round(download_seconds, 3),
+            'postprocess_wait': round(stage_timings['wait'], 3),
+            'postprocess': round(stage_timings['run'], 3),
+            'postprocess_cpu': round(stage_timings['cpu'], 3)
+        }
+        return downloader.complete_download(job_id, url, format_id, temp_dir, file_path, result_info, timings)
+    except Exception as e:
+        downloader.fail_download(job_id, temp_dir, e)
+        return None
+
+# ✅ CAROUSEL DOWNLOAD SETTINGS
+CAROUSEL_ITEM_CONCURRENCY = int(os.environ.get('CAROUSEL_ITEM_CONCURRENCY', 3))  # parallel items per job
+IMAGE_EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp', 'image/heic': 'heic'}
+
+async def download_carousel_image(entry, temp_dir, index, title):
+    """Fetch one carousel image over the shared HTTP client; returns the file path"""
+    image = best_image(entry)
+    if not image:
+        raise Exception("No image URL for this item")
+    await rate_governor.acquire()
+    try:
+        response = await http_client.get(image['url'], headers=image.get('http_headers') or entry.get('http_headers'))
+    except httpx.HTTPError as e:
+        raise RetryDownload(e)
+    if response.status_code in (403, 410):
+        raise RetryDownload(Exception(f"CDN responded with {response.status_code}"), delay=0, stale=True)
+    if response.status_code >= 400:
+        raise RetryDownload(Exception(f"CDN responded with {response.status_code}"))
+    
+    ext = IMAGE_EXTENSIONS.get(response.headers.get('content-type', '').split(';')[0], 'jpg')
+    file_path = os.path.join(temp_dir, f'{index:02d}_{sanitize_title(title)}.{ext}')
+    
+    def write_file():
+        with open(file_path, 'wb') as file:
+            file.write(response.content)
+    
+    await asyncio.get_event_loop().run_in_executor(None, write_file)
+    return file_path
+
+async def download_carousel_async(job_id, session_id, cached_data, indexes, max_attempts=2):
+    """Download the selected carousel items in parallel, with per-item progress, under one job
+    
+    Each item gets its own temp dir and is registered as file '<job_id>-<index>',
+    so items can be fetched one by one or released individually by the ZIP stream.
+    """
+    update_job(job_id, status='downloading', progress=5)
+    raw_info = cached_data.get('raw_info')
+    if not cdn_urls_fresh(raw_info):
+        raw_info = await refresh_session_info(session_id, cached_data) or raw_info
+    
+    title = cached_data['info'].get('title') or 'instagram_content'
+    items = download_jobs.fields(job_id, 'items')[0]
+    items = [dict(item) for item in items]
+    items_lock = threading.Lock()  # Progress hooks write from worker threads
+    last_push = [0.0]
+    
+    def publish(force=False):
+        now = time.monotonic()
+        with items_lock:
+            if not force and now - last_push[0] < PROGRESS_PUSH_INTERVAL:
+                return
+            last_push[0] = now
+            snapshot = [dict(item) for item in items]
+        progress = sum(item['progress'] for item in snapshot) / len(snapshot)
+        update_job(job_id, items=snapshot, progress=min(max(progress, 5), 99))
+    
+    def set_item(item, **fields):
+        with items_lock:
+            item.update(fields)
+    
+    semaphore = asyncio.Semaphore(CAROUSEL_ITEM_CONCURRENCY)
+    
+    async def fetch(item):
+        nonlocal raw_info
+        index = item['index']
+        async with semaphore:
+            temp_dir = make_temp_dir()
+            set_item(item, status='downloading', progress=1)
+            publish(force=True)
+            
+            def on_progress(progress):
+                set_item(item, progress=progress)
+                publish()
+            
+            entry = None
+            try:
+                for attempt in range(max_attempts):
+                    entries = carousel_entries(raw_info or {})
+                    entry = entries[index - 1] if index <= len(entries) else None
+                    if not entry:
+                        raise Exception("Item is no longer part of this post")
                     try:
-                        height = int(height) if height else 0
-                        width = int(width) if width else 0
-                        tbr = float(tbr) if tbr else 0
-                    except (ValueError, TypeError):
-                        height = width = tbr = 0
-                    
-                    quality_score = (height * width) + (tbr * 1000)
-                    fmt['quality_score'] = quality_score
-                    video_formats.append(fmt)
+                        if item['type'] == 'image':
+                            file_path = await download_carousel_image(entry, temp_dir, index, title)
+                        else:
+                            paths, item_info = await run_attempt('download', downloader.download_item, entry, temp_dir, index, on_progress)
+                            file_path = None
+                        break
+                    except RetryDownload as retry:
+                        if attempt == max_attempts - 1 or circuit_breaker.retry_after():
+                            raise retry.error
+                        if retry.stale:
+                            raw_info = await refresh_session_info(session_id, cached_data) or raw_info
+                        await backoff('download', retry.delay)
+                if file_path is None:
+                    # Separate video/audio streams are muxed in the post-processing stage
+                    file_path, _ = await postprocess_download(job_id, 'best', paths, item_info, label=f'{job_id}-{index}')
+            except Exception as e:
+                temp_reaper.remove_dirs([temp_dir])
+                errors_total.inc(stage='download', error_type=job_error_type(e))
+                set_item(item, status='failed', error=str(e))
+                publish(force=True)
+                return
             
-            # Sort by quality score (highest first)
-            video_formats.sort(key=lambda x: x.get('quality_score', 0), reverse=True)
+            file_id = f'{job_id}-{index}'
+            register_temp_file(file_id, file_path, temp_dir)
+            set_item(
+                item,
+                status='completed',
+                progress=100,
+                file_id=file_id,
+                filename=os.path.basename(file_path),
+                file_size=os.path.getsize(file_path)
+            )
+            publish(force=True)
+    
+    await asyncio.gather(*(fetch(item) for item in items))
+    
+    completed = [item for item in items if item['status'] == 'completed']
+    if not completed:
+        update_job(job_id, status='failed', items=items, error='Download failed: no carousel item could be downloaded')
+        return None
+    update_job(
+        job_id,
+        status='completed',
+        progress=100,
+        items=items,
+        file_size=sum(item['file_size'] for item in completed),
+        info={'title': title, 'item_count': len(completed)}
+    )
+    return [item['file_id'] for item in completed]
+
+# ✅ DOWNLOAD QUEUE SETTINGS
+DOWNLOAD_QUEUE_DEPTH = int(os.environ.get('DOWNLOAD_QUEUE_DEPTH', 100))
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 6))  # Leaves pool threads for /extract
+SMALL_FORMAT_BYTES = int(os.environ.get('SMALL_FORMAT_BYTES', 20 * 1024 ** 2))
+PRIORITY_LANES = ('audio', 'small', 'standard')
+
+def job_priority(format_id, format_info=None):
+    """Lane index for a download: audio-only first, then small formats"""
+    if format_id in AUDIO_FORMATS:
+        return 0
+    filesize = (format_info or {}).get('filesize')
+    if filesize and filesize <= SMALL_FORMAT_BYTES:
+        return 1
+    return 2
+
+class DownloadQueue:
+    """Bounded download queue with per-priority lanes, drained by a fixed set of workers
+    
+    Lives on the event loop; every method must be called from it.
+    """
+
+    def __init__(self, max_depth, concurrency, lanes=PRIORITY_LANES):
+        self.max_depth = max_depth
+        self.concurrency = concurrency
+        self.lane_names = lanes
+        self.lanes = [deque() for _ in lanes]  # (job_id, coroutine factory)
+        self.active = 0
+        self.avg_job_seconds = 20.0  # Moving average, seeded with a typical job
+        self.submitted = 0
+        self.rejected = 0
+        self._wakeup = None
+        self._workers = []
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def full(self):
+        return len(self) >= self.max_depth
+
+    def submit(self, job_id, priority, job_factory):
+        """Queue a job; returns False when the queue is at capacity"""
+        if self.full():
+            self.rejected += 1
+            return False
+        self.lanes[priority].append((job_id, job_factory))
+        self.submitted += 1
+        self._wakeup.set()
+        return True
+
+    def position(self, job_id):
+        """1-based position of a queued job across all lanes, or None"""
+        ahead = 0
+        for lane in self.lanes:
+            for index, (queued_id, _) in enumerate(lane):
+                if queued_id == job_id:
+                    return ahead + index + 1
+            ahead += len(lane)
+        return None
+
+    def cancel(self, job_id):
+        """Drop a job that has not started yet; False if it is not queued"""
+        for lane in self.lanes:
+            for item in lane:
+                if item[0] == job_id:
+                    lane.remove(item)
+                    return True
+        return False
+
+    def estimated_wait(self, position):
+        """Seconds until the job at this position should start"""
+        jobs_before_free_slot = max(0, position + self.active - self.concurrency)
+        return jobs_before_free_slot * self.avg_job_seconds / self.concurrency
+
+    def retry_after(self):
+        """Seconds a rejected client should wait before trying again"""
+        return max(1, math.ceil(self.avg_job_seconds / self.concurrency))
+
+    def _pop(self):
+        for lane in self.lanes:
+            if lane:
+                return lane.popleft()
+        return None
+
+    async def _worker(self):
+        while True:
+            item = self._pop()
+            if item is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
             
-            # Select top quality formats
-            seen_heights = set()
-            for fmt in video_formats:
+            job_id, job_factory = item
+            self.active += 1
+            started = time.monotonic()
+            try:
+                await job_factory()
+            except Exception as e:
+                print(f"Download worker error for {job_id}: {e}")
+            finally:
+                self.active -= 1
+                elapsed = time.monotonic() - started
+                self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def stats(self):
+        return {
+            'depth': len(self),
+            'max_depth': self.max_depth,
+            'lanes': {name: len(lane) for name, lane in zip(self.lane_names, self.lanes)},
+            'active': self.active,
+            'concurrency': self.concurrency,
+            'avg_job_seconds': round(self.avg_job_seconds, 2),
+            'submitted': self.submitted,
+            'rejected': self.rejected
+        }
+
+download_queue = DownloadQueue(DOWNLOAD_QUEUE_DEPTH, DOWNLOAD_CONCURRENCY)
+
+downloader = InstagramDownloader()
+
+@app.on_event("startup")
+async def startup_event():
+    """Start background cleanup task and download workers"""
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(60.0, connect=15.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        follow_redirects=True
+    )
+    job_events.bind(asyncio.get_event_loop())
+    temp_reaper.start()
+    asyncio.create_task(cleanup_expired_state())
+    download_queue.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled CDN connections"""
+    if http_client:
+        await http_client.aclose()
+
+def build_video_info(info, content_type):
+    """Turn a yt-dlp info dict into the format list and metadata sent to the client"""
+    # ✅ ENHANCED FORMAT PROCESSING FOR HIGHEST QUALITY
+    formats = []
+    if 'formats' in info and info['formats']:
+        # Filter and sort for highest quality video formats
+        video_formats = []
+        
+        for fmt in info['formats']:
+            if (fmt.get('vcodec') != 'none' and
+                 fmt.get('acodec') != 'none' and
+                 fmt.get('height') and fmt.get('width')):
+                
+                # ✅ SAFE QUALITY SCORE CALCULATION WITH NONE CHECKS
                 height = fmt.get('height') or 0
+                width = fmt.get('width') or 0
+                tbr = fmt.get('tbr') or 0
+                
+                # Ensure all values are numbers
                 try:
                     height = int(height) if height else 0
+                    width = int(width) if width else 0
+                    tbr = float(tbr) if tbr else 0
                 except (ValueError, TypeError):
-                    height = 0
+                    height = width = tbr = 0
                 
-                if height and height not in seen_heights and len(formats) < 4:
-                    seen_heights.add(height)
-                    
-                    # ✅ ENHANCED QUALITY LABELS
-                    if height >= 1080:
-                        quality_label = f"Ultra HD ({height}p) - Best Quality"
-                    elif height >= 720:
-                        quality_label = f"Full HD ({height}p) - High Quality"
-                    elif height >= 480:
-                        quality_label = f"HD ({height}p) - Good Quality"
-                    else:
-                        quality_label = f"Standard ({height}p)"
-                    
-                    formats.append({
-                        'format_id': fmt.get('format_id'),
-                        'ext': fmt.get('ext', 'mp4'),
-                        'quality': quality_label,
-                        'filesize': fmt.get('filesize'),
-                        'width': fmt.get('width'),
-                        'height': fmt.get('height'),
-                        'tbr': fmt.get('tbr'),
-                        'type': 'video'
-                    })
+                quality_score = (height * width) + (tbr * 1000)
+                fmt['quality_score'] = quality_score
+                video_formats.append(fmt)
         
-        # ✅ ALWAYS ADD BEST QUALITY OPTION
-        if not formats:
-            formats.append({
-                'format_id': 'best',
-                'ext': 'mp4',
-                'quality': 'Highest Available Quality (Auto)',
-                'type': 'video'
-            })
+        # Sort by quality score (highest first)
+        video_formats.sort(key=lambda x: x.get('quality_score', 0), reverse=True)
         
-        # Add audio option
+        # Select top quality formats
+        seen_heights = set()
+        for fmt in video_formats:
+            height = fmt.get('height') or 0
+            try:
+                height = int(height) if height else 0
+            except (ValueError, TypeError):
+                height = 0
+            
+            if height and height not in seen_heights and len(formats) < 4:
+                seen_heights.add(height)
+                
+                # ✅ ENHANCED QUALITY LABELS
+                if height >= 1080:
+                    quality_label = f"Ultra HD ({height}p) - Best Quality"
+                elif height >= 720:
+                    quality_label = f"Full HD ({height}p) - High Quality"
+                elif height >= 480:
+                    quality_label = f"HD ({height}p) - Good Quality"
+                else:
+                    quality_label = f"Standard ({height}p)"
+                
+                formats.append({
+                    'format_id': fmt.get('format_id'),
+                    'ext': fmt.get('ext', 'mp4'),
+                    'quality': quality_label,
+                    'filesize': fmt.get('filesize'),
+                    'width': fmt.get('width'),
+                    'height': fmt.get('height'),
+                    'tbr': fmt.get('tbr'),
+                    'type': 'video'
+                })
+    
+    # ✅ ALWAYS ADD BEST QUALITY OPTION
+    if not formats:
+        formats.append({
+            'format_id': 'best',
+            'ext': 'mp4',
+            'quality': 'Highest Available Quality (Auto)',
+            'type': 'video'
+        })
+    
+    # Add audio options (original AAC first, MP3 re-encode on request)
+    for format_id, audio in AUDIO_FORMATS.items():
         formats.append({
-            'format_id': 'audio_only',
-            'ext': 'mp3',
-            'quality': 'Audio Only (320kbps MP3)',
+            'format_id': format_id,
+            'ext': audio['ext'],
+            'quality': audio['quality'],
             'type': 'audio'
         })
+    
+    # ✅ CAROUSEL ITEMS (VIDEOS AND IMAGES); A SINGLE-IMAGE POST IS A ONE-ITEM CAROUSEL
+    entries = carousel_entries(info)
+    items = [carousel_item(index, entry) for index, entry in enumerate(entries, 1) if entry]
+    
+    return {
+        'title': info.get('title', 'Instagram Content'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail') or (items[0]['thumbnail'] if items else None),
+        'uploader': info.get('uploader'),
+        'view_count': info.get('view_count'),
+        'formats': formats,
+        'content_type': content_type,
+        **({'items': items} if items else {})
+    }
+
+def looks_like_video(info):
+    """True when an info dict describes a video, even one whose formats were not found"""
+    return bool(info.get('duration') or info.get('vcodec') not in (None, 'none'))
+
+def is_image_post(info):
+    """Single-image post: no formats, not a video, but an image to download"""
+    return (not info.get('formats') and not looks_like_video(info)
+            and bool(info.get('thumbnails') or info.get('thumbnail')))
+
+def carousel_entries(info):
+    """Per-item info dicts of a multi-item post (empty for a plain video)"""
+    if info.get('_type') == 'playlist' or info.get('entries'):
+        return info.get('entries') or []
+    if is_image_post(info):
+        return [info]
+    return []
+
+def best_image(entry):
+    """Largest image of a carousel item, from its thumbnail list"""
+    images = [image for image in entry.get('thumbnails') or [] if image.get('url')]
+    if images:
+        return max(images, key=lambda image: ((image.get('width') or 0) * (image.get('height') or 0), image.get('preference') or 0))
+    return {'url': entry['thumbnail']} if entry.get('thumbnail') else None
+
+def carousel_item(index, entry):
+    """Client-facing summary of one carousel entry"""
+    if any(fmt.get('vcodec') != 'none' for fmt in entry.get('formats') or []):
+        return {
+            'index': index,
+            'type': 'video',
+            'thumbnail': entry.get('thumbnail'),
+            'duration': entry.get('duration'),
+            'width': entry.get('width'),
+            'height': entry.get('height'),
+            'ext': 'mp4'
+        }
+    image = best_image(entry) or {}
+    return {
+        'index': index,
+        'type': 'image',
+        'thumbnail': image.get('url'),
+        'width': image.get('width'),
+        'height': image.get('height'),
+        'ext': 'jpg'
+    }
+
+async def create_session(url, content_type, video_info, raw_info=None, raw_size=None):
+    """Register a download session for an extracted post
+    
+    With a shared backend this returns once the session is written there, so
+    a /download routed to a sibling worker can already find it.
+    """
+    session_id = str(uuid.uuid4())
+    session = {
+        'url': url,
+        'content_type': content_type,
+        'info': video_info,
+        'raw_info': raw_info
+    }
+    write = store_session(session_id, session, raw_size)
+    if write is not None:
+        await asyncio.wrap_future(write)
+    return session_id
+
+def store_session(session_id, session, raw_size=None):
+    """Put a session in video_cache (replacing any entry); returns the backend write's Future"""
+    raw_info = session['raw_info']
+    if raw_size is None:
+        raw_size = approx_size(raw_info)
+    # info and raw_info are the extract cache's objects, shared by every session for the post
+    own_size = approx_size({key: value for key, value in session.items() if key not in ('info', 'raw_info')})
+    shared_parts = [(session['info'], approx_size(session['info']))]
+    if raw_info is not None:
+        shared_parts.append((raw_info, raw_size))
+    return video_cache.put(session_id, session, own_size, shared_parts)
+
+def find_progressive_format(raw_info, format_id):
+    """yt-dlp format with both video and audio that can be streamed as-is, if any"""
+    for fmt in (raw_info or {}).get('formats') or []:
+        if (fmt.get('format_id') == format_id and fmt.get('url') and
+                fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none'):
+            return fmt
+    return None
+
+async def refresh_session_info(session_id, cached_data):
+    """Re-extract a session's post after its signed CDN URLs expired
+    
+    The session is stored again with the fresh raw_info rather than patched in
+    place, so its size is recharged and sibling workers get the new URLs too.
+    """
+    shortcode = extract_shortcode(cached_data['url'])
+    if shortcode:
+        extract_cache.pop(shortcode)
+    result = await extract_info_async(cached_data['url'], cached_data.get('content_type'))
+    if not result['success']:
+        return None
+    raw_info = result['data']
+    write = store_session(session_id, dict(cached_data, raw_info=raw_info))
+    if write is not None:
+        await asyncio.wrap_future(write)
+    return raw_info
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    return templates.TemplateResponse("index.html", {"request": request})
+
+async def extract_for_url(url, content_type=None):
+    """Extract one post and open a download session; returns the /extract payload"""
+    url = (url or '').strip()
+    
+    if not url:
+        return {
+            'success': False,
+            'error': 'Please provide a URL',
+            'error_type': 'missing_url'
+        }
+    
+    if not downloader.is_valid_instagram_url(url):
+        return {
+            'success': False,
+            'error': 'Please provide a valid Instagram URL',
+            'error_type': 'invalid_url'
+        }
+    
+    if not content_type:
+        content_type = downloader.detect_content_type(url)
+    
+    # ✅ STORIES HANDLING
+    if content_type == 'story':
+        return {
+            'success': False,
+            'error': 'Instagram Stories Not Supported',
+            'error_type': 'story_not_supported',
+            'message': 'Instagram Stories cannot be downloaded due to platform restrictions.',
+            'details': {
+                'reasons': [
+                    'Stories require Instagram login and authentication',
+                    'Stories expire after 24 hours',
+                    'Most stories are private or restricted',
+                    'Instagram has strict anti-scraping measures'
+                ],
+                'alternatives': [
+                    'Try downloading Instagram Reels instead',
+                    'Use Instagram Posts (they work reliably)',
+                    'Check if the content is available as a Reel'
+                ]
+            },
+            'recommendation': 'Please try using Instagram Reels or Posts instead!'
+        }
+    
+    shortcode = extract_shortcode(url)
+    
+    # ✅ SERVE REPEAT EXTRACTIONS FROM CACHE (NO THREAD POOL)
+    cached = extract_cache.get(shortcode) if shortcode else None
+    if cached is not None:
+        video_info = cached['info']
+        raw_info = cached['raw_info']
+        raw_size = cached['raw_size']
+        if video_info['content_type'] != content_type:
+            video_info = dict(video_info, content_type=content_type)
+    else:
+        # ✅ KNOWN-BAD POSTS ANSWER FROM THE NEGATIVE CACHE
+        failure = negative_cache.get(shortcode) if shortcode else None
+        if failure is not None:
+            negative_cache_hits[failure['error_type']] += 1
+            return dict(failure)
         
-        # Create session
-        session_id = str(uuid.uuid4())
-        video_cache[session_id] = {
-            'url': url,
-            'content_type': content_type,
-            'info': {
-                'title': info.get('title', 'Instagram Content'),
-                'duration': info.get('duration'),
-                'thumbnail': info.get('thumbnail'),
-                'uploader': info.get('uploader'),
-                'view_count': info.get('view_count'),
-                'formats': formats,
-                'content_type': content_type
+        # ✅ FAIL FAST WHILE INSTAGRAM IS RATE LIMITING US
+        retry_after = circuit_breaker.retry_after()
+        if retry_after:
+            return circuit_open_result(retry_after)
+        
+        # Extract info for other content
+        result = await extract_info_async(url, content_type)
+        
+        if not result['success']:
+            failure = {
+                'success': False,
+                'error': result['error'],
+                'error_type': result.get('error_type', 'unknown'),
+                'suggestion': result.get('suggestion', 'Try using a different public Instagram post or reel.'),
+                **({'retry_after': result['retry_after']} if result.get('retry_after') else {})
+            }
+            ttl = NEGATIVE_CACHE_TTLS.get(failure['error_type'])
+            if shortcode and ttl:
+                negative_cache.set(shortcode, failure, ttl)
+            return failure
+        
+        raw_info = result['data']
+        raw_size = approx_size(raw_info)  # Measured once, reused by cache hits
+        video_info = build_video_info(raw_info, content_type)
+        if shortcode:
+            # Never outlive the signed CDN URLs the entry will be downloaded from
+            ttl = EXTRACT_CACHE_TTL
+            expires_at = cdn_urls_expire_at(raw_info)
+            if expires_at:
+                ttl = min(ttl, expires_at - time.time() - CDN_URL_EXPIRY_MARGIN)
+            if ttl > 0:
+                extract_cache.set(shortcode, {'info': video_info, 'raw_info': raw_info, 'raw_size': raw_size}, ttl)
+    
+    # Create session
+    session_id = await create_session(url, content_type, video_info, raw_info, raw_size)
+    
+    return {
+        'success': True,
+        'session_id': session_id,
+        'thumbnail_url': f'/thumb/{session_id}',
+        'video_info': video_info,
+        'content_type': content_type,
+        'quality_note': 'All downloads are optimized for highest available quality'
+    }
+
+@app.post("/extract")
+async def extract_video_info(request_data: URLRequest):
+    """Extract video information - Enhanced Cloud Support"""
+    try:
+        result = await extract_for_url(request_data.url, request_data.content_type)
+        if not result['success']:
+            errors_total.inc(stage='extract', error_type=result.get('error_type'))
+        headers = {'Retry-After': str(result['retry_after'])} if result.get('retry_after') else None
+        return JSONResponse(status_code=200, headers=headers, content=result)
+        
+    except Exception as e:
+        errors_total.inc(stage='extract', error_type='server_error')
+        return JSONResponse(
+            status_code=200,
+            content={
+                'success': False,
+                'error': f'Server error: {str(e)}',
+                'error_type': 'server_error'
             }
-        }
-        
+        )
+
+# ✅ BATCH EXTRACTION SETTINGS
+EXTRACT_BATCH_MAX_URLS = int(os.environ.get('EXTRACT_BATCH_MAX_URLS', 500))
+EXTRACT_BATCH_CONCURRENCY = int(os.environ.get('EXTRACT_BATCH_CONCURRENCY', 4))  # Leaves pool threads for downloads
+
+@app.post("/extract/batch")
+async def extract_batch(request_data: BatchURLRequest):
+    """✅ EXTRACT MANY URLS, STREAMING NDJSON RESULTS AS EACH ONE FINISHES"""
+    urls = [url.strip() for url in request_data.urls]
+    if not urls:
         return JSONResponse(
             status_code=200,
             content={
-                'success': True,
-                'session_id': session_id,
-                'video_info': video_cache[session_id]['info'],
-                'content_type': content_type,
-                'quality_note': 'All downloads are optimized for highest available quality'
+                'success': False,
+                'error': 'Please provide at least one URL',
+                'error_type': 'missing_url'
             }
         )
-        
-    except Exception as e:
+    if len(urls) > EXTRACT_BATCH_MAX_URLS:
         return JSONResponse(
             status_code=200,
             content={
                 'success': False,
-                'error': f'Server error: {str(e)}',
-                'error_type': 'server_error'
+                'error': f'Too many URLs (max {EXTRACT_BATCH_MAX_URLS} per batch)',
+                'error_type': 'batch_too_large'
             }
         )
+    
+    # Links to the same post (share links, /reel/ vs /p/, tracking params) are extracted once
+    groups: Dict[str, List[int]] = {}
+    for index, url in enumerate(urls):
+        groups.setdefault(extract_shortcode(url) or url, []).append(index)
+    
+    semaphore = asyncio.Semaphore(EXTRACT_BATCH_CONCURRENCY)
+    
+    async def extract_group(indexes):
+        async with semaphore:
+            try:
+                result = await extract_for_url(urls[indexes[0]], request_data.content_type)
+            except Exception as e:
+                result = {
+                    'success': False,
+                    'error': f'Server error: {str(e)}',
+                    'error_type': 'server_error'
+                }
+        if not result['success']:
+            errors_total.inc(stage='extract', error_type=result.get('error_type'))
+        return indexes, result
+    
+    async def result_lines():
+        tasks = [asyncio.ensure_future(extract_group(indexes)) for indexes in groups.values()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                indexes, result = await next_done
+                for index in indexes:
+                    yield json.dumps({'index': index, 'url': urls[index], **result}) + "\n"
+        finally:
+            # Client went away - stop extracting for it
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(
+        result_lines(),
+        media_type="application/x-ndjson",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+
+def queue_full_response():
+    """429 telling the client when a queue slot should be free"""
+    download_queue.rejected += 1
+    errors_total.inc(stage='download', error_type='queue_full')
+    retry_after = download_queue.retry_after()
+    return JSONResponse(
+        status_code=429,
+        headers={'Retry-After': str(retry_after)},
+        content={
+            'success': False,
+            'error': 'Too many downloads in progress. Please try again shortly.',
+            'error_type': 'queue_full',
+            'retry_after': retry_after
+        }
+    )
 
 @app.post("/download")
-async def download_video_endpoint(request_data: DownloadRequest, background_tasks: BackgroundTasks):
-    """Start download process"""
+async def download_video_endpoint(request_data: DownloadRequest):
+    """Start download process
+    
+    With PROXY_MODE on (the default) every progressive format is answered
+    with a /proxy URL, so the tee stream (stream_url, served from the .part
+    file while the job runs) is only offered when PROXY_MODE=off.
+    """
     try:
         session_id = request_data.session_id
         format_id = request_data.format_id
         
-        if not session_id or session_id not in video_cache:
+        cached_data, session_error = await video_cache.lookup(session_id) if session_id else (None, 'invalid_session')
+        if session_error == 'session_expired':
+            return JSONResponse(
+                status_code=200,
+                content={
+                    'success': False,
+                    'error': 'Session expired. Please extract the post again.',
+                    'error_type': 'session_expired'
+                }
+            )
+        if session_error:
             return JSONResponse(
                 status_code=200,
                 content={
@@ -1434,8 +3722,6 @@ async def download_video_endpoint(request_data: DownloadRequest, background_task
                     'error_type': 'invalid_session'
                 }
             )
-        
-        cached_data = video_cache[session_id]
         content_type = cached_data.get('content_type', 'unknown')
         
         if content_type == 'story':
@@ -1448,24 +3734,125 @@ async def download_video_endpoint(request_data: DownloadRequest, background_task
                 }
             )
         
-        job_id = str(uuid.uuid4())
-        
-        with job_lock:
-            download_jobs[job_id] = {
+        # ✅ CAROUSEL MODE - SELECTED ITEMS DOWNLOAD IN PARALLEL UNDER ONE JOB
+        carousel = {item['index']: item for item in cached_data['info'].get('items') or []}
+        if carousel:
+            indexes = list(dict.fromkeys(request_data.items or carousel))
+            if not indexes or any(index not in carousel for index in indexes):
+                return JSONResponse(
+                    status_code=200,
+                    content={
+                        'success': False,
+                        'error': 'Please select items from this post',
+                        'error_type': 'invalid_items'
+                    }
+                )
+            if download_queue.full():
+                return queue_full_response()
+            
+            job_id = str(uuid.uuid4())
+            download_jobs.create(job_id, **{
                 'status': 'queued',
                 'progress': 0,
                 'video_title': cached_data['info'].get('title', 'Instagram Content'),
-                'format_id': format_id,
+                'format_id': 'carousel',
                 'content_type': content_type,
-                'created_at': datetime.now().isoformat()
-            }
+                'created_at': datetime.now().isoformat(),
+                'streamable': False,
+                'items': [
+                    {'index': index, 'type': carousel[index]['type'], 'status': 'queued', 'progress': 0}
+                    for index in indexes
+                ]
+            })
+            download_queue.submit(
+                job_id,
+                job_priority('carousel'),
+                lambda: download_carousel_async(job_id, session_id, cached_data, indexes)
+            )
+            return JSONResponse(
+                status_code=200,
+                content={
+                    'success': True,
+                    'job_id': job_id,
+                    'item_count': len(indexes),
+                    'message': f'Downloading {len(indexes)} items from this Instagram {content_type}'
+                }
+            )
+        
+        # ✅ PROXY MODE - PROGRESSIVE FORMATS STREAM STRAIGHT FROM THE CDN
+        if PROXY_MODE and find_progressive_format(cached_data.get('raw_info'), format_id):
+            return JSONResponse(
+                status_code=200,
+                content={
+                    'success': True,
+                    'mode': 'proxy',
+                    'download_url': f"/proxy/{session_id}/{format_id}",
+                    'message': f'Direct stream ready for Instagram {content_type}'
+                }
+            )
+        
+        format_info = next(
+            (fmt for fmt in cached_data['info'].get('formats', []) if fmt.get('format_id') == format_id),
+            None
+        )
+        # Formats listed by /extract are single-file progressive (video + audio)
+        streamable = bool(format_info) and format_info.get('type') == 'video' and format_id != 'best'
+        
+        job_id = str(uuid.uuid4())
+        job_record = {
+            'status': 'queued',
+            'progress': 0,
+            'video_title': cached_data['info'].get('title', 'Instagram Content'),
+            'format_id': format_id,
+            'content_type': content_type,
+            'created_at': datetime.now().isoformat(),
+            'streamable': streamable,
+            'expected_size': format_info.get('filesize') if streamable else None,
+            'ext': format_info.get('ext', 'mp4') if format_info else None
+        }
+        
+        # ✅ MEDIA CACHE HIT - COMPLETE WITHOUT A WORKER THREAD
+        cache_key = media_cache_key(cached_data['url'], format_id)
+        cached_file = media_cache.acquire(cache_key) if cache_key else None
+        if cached_file:
+            register_temp_file(job_id, cached_file['file_path'], cached_file['temp_dir'], cache_key)
+            download_jobs.create(job_id, **{
+                **job_record,
+                'status': 'completed',
+                'progress': 100,
+                'file_path': cached_file['file_path'],
+                'filename': cached_file['filename'],
+                'file_size': cached_file['file_size'],
+                'temp_dir': cached_file['temp_dir'],
+                'info': cached_file['info'],
+                'cached': True
+            })
+            return JSONResponse(
+                status_code=200,
+                content={
+                    'success': True,
+                    'job_id': job_id,
+                    'message': f'Instagram {content_type} served from cache'
+                }
+            )
+        
+        # ✅ ADMISSION CONTROL - REJECT WHEN THE QUEUE IS FULL
+        if download_queue.full():
+            return queue_full_response()
         
-        background_tasks.add_task(
-            download_video_async, 
-            cached_data['url'], 
-            format_id, 
-            job_id, 
-            content_type
+        download_jobs.create(job_id, **job_record)
+        
+        download_queue.submit(
+            job_id,
+            job_priority(format_id, format_info),
+            lambda: download_video_async(
+                cached_data['url'],
+                format_id,
+                job_id,
+                content_type,
+                cached_data.get('raw_info'),
+                streamable
+            )
         )
         
         return JSONResponse(
@@ -1473,11 +3860,14 @@ async def download_video_endpoint(request_data: DownloadRequest, background_task
             content={
                 'success': True,
                 'job_id': job_id,
-                'message': f'Enhanced cloud download started for Instagram {content_type}'
+                'message': f'Enhanced cloud download started for Instagram {content_type}',
+                # Progressive formats can be streamed while yt-dlp is still downloading
+                **({'stream_url': f"/download-file/{job_id}"} if streamable else {})
             }
         )
         
     except Exception as e:
+        errors_total.inc(stage='download', error_type='download_start_error')
         return JSONResponse(
             status_code=200,
             content={
@@ -1487,93 +3877,871 @@ async def download_video_endpoint(request_data: DownloadRequest, background_task
             }
         )
 
+async def job_status_payload(job_id):
+    """Client-facing view of a job, or None if it does not exist"""
+    job_data = await download_jobs.get_async(job_id)
+    if job_data is None:
+        return None
+    
+    # Add download URL if completed
+    if job_data['status'] == 'completed':
+        job_data['download_url'] = f"/download-file/{job_id}"
+    
+    # Carousel jobs download as one ZIP, or item by item
+    if job_data.get('items'):
+        job_data['items'] = [
+            dict(item, download_url=f"/download-file/{item['file_id']}") if item.get('file_id') else item
+            for item in job_data['items']
+        ]
+        if job_data['status'] == 'completed':
+            job_data['download_url'] = f"/download-zip?job_ids={job_id}"
+    
+    # ✅ QUEUE POSITION AND ESTIMATED START
+    if job_data['status'] == 'queued':
+        position = download_queue.position(job_id)
+        if position:
+            wait_seconds = download_queue.estimated_wait(position)
+            job_data['queue_position'] = position
+            job_data['estimated_wait_seconds'] = round(wait_seconds, 1)
+            job_data['estimated_start'] = (datetime.now() + timedelta(seconds=wait_seconds)).isoformat()
+    
+    return job_data
+
 @app.get("/status/{job_id}")
 async def get_download_status(job_id: str):
     """Check download status"""
-    with job_lock:
-        if job_id not in download_jobs:
-            return JSONResponse(
-                status_code=200,
-                content={
-                    'success': False,
-                    'error': 'Job not found',
-                    'error_type': 'job_not_found'
-                }
-            )
-        
-        job_data = download_jobs[job_id].copy()
-        
-        # Add download URL if completed
-        if job_data['status'] == 'completed':
-            job_data['download_url'] = f"/download-file/{job_id}"
-        
+    job_data = await job_status_payload(job_id)
+    if job_data is None:
         return JSONResponse(
             status_code=200,
             content={
-                'success': True,
-                'job_id': job_id,
-                **job_data
+                'success': False,
+                'error': 'Job not found',
+                'error_type': 'job_not_found'
+            }
+        )
+    
+    return JSONResponse(
+        status_code=200,
+        content={
+            'success': True,
+            'job_id': job_id,
+            **job_data
+        }
+    )
+
+@app.post("/cancel/{job_id}")
+async def cancel_download(job_id: str):
+    """✅ CANCEL A JOB THAT IS STILL QUEUED OR WAITING ON/RUNNING FFMPEG"""
+    status = await download_jobs.fields_async(job_id, 'status')
+    if status is None:
+        return JSONResponse(
+            status_code=200,
+            content={
+                'success': False,
+                'error': 'Job not found',
+                'error_type': 'job_not_found'
+            }
+        )
+    
+    if download_queue.cancel(job_id):
+        update_job(job_id, status='failed', error='Download failed: Cancelled')
+        errors_total.inc(stage='download', error_type='cancelled')
+        cancelled = True
+    else:
+        # Carousel items are in the stage as '<job_id>-<index>'
+        items = (download_jobs.fields(job_id, 'items') or [None])[0] or []
+        stage_ids = [job_id] + [f"{job_id}-{item['index']}" for item in items]
+        cancelled = any([postprocess_stage.cancel(stage_id) for stage_id in stage_ids])
+    
+    if not cancelled:
+        return JSONResponse(
+            status_code=200,
+            content={
+                'success': False,
+                'error': f'Job is {status[0]} and can no longer be cancelled',
+                'error_type': 'not_cancellable'
             }
         )
+    
+    return JSONResponse(
+        status_code=200,
+        content={
+            'success': True,
+            'job_id': job_id,
+            'cancelled': True
+        }
+    )
+
+@app.get("/events/{job_id}")
+async def job_events_stream(job_id: str):
+    """✅ PUSH STATUS AND PROGRESS AS SERVER-SENT EVENTS"""
+    async def event_generator():
+        # Subscribe before the first snapshot so no change slips in between
+        queue = job_events.subscribe(job_id)
+        try:
+            last_sent = None
+            while True:
+                job_data = await job_status_payload(job_id)
+                if job_data is None:
+                    payload = {'success': False, 'error': 'Job not found', 'error_type': 'job_not_found'}
+                    yield f"event: status\ndata: {json.dumps(payload)}\n\n"
+                    return
+                
+                # estimated_start moves with the clock; only a new position or wait estimate is news
+                snapshot = {key: value for key, value in job_data.items() if key != 'estimated_start'}
+                if snapshot != last_sent:
+                    last_sent = snapshot
+                    payload = {'success': True, 'job_id': job_id, **job_data}
+                    yield f"event: status\ndata: {json.dumps(payload)}\n\n"
+                
+                if job_data['status'] in ('completed', 'failed'):
+                    return
+                
+                # Queue position moves without job events, so re-check queued jobs sooner
+                timeout = 2 if job_data['status'] == 'queued' else 15
+                if job_id not in download_jobs:
+                    # A sibling worker owns the job and its events; poll the shared copy
+                    timeout = 1
+                try:
+                    await asyncio.wait_for(queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            job_events.unsubscribe(job_id, queue)
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+
+@app.get("/proxy/{session_id}/{format_id}")
+async def proxy_download(session_id: str, format_id: str, request: Request):
+    """✅ STREAM A PROGRESSIVE FORMAT FROM THE CDN WITHOUT TOUCHING DISK"""
+    cached_data, session_error = await video_cache.lookup(session_id)
+    if session_error == 'session_expired':
+        raise HTTPException(status_code=410, detail="Session expired")
+    if session_error:
+        raise HTTPException(status_code=404, detail="Session not found")
+    raw_info = cached_data.get('raw_info')
+    if not cdn_urls_fresh(raw_info):
+        raw_info = await refresh_session_info(session_id, cached_data)
+    
+    for attempt in range(2):
+        if raw_info is None:
+            raise HTTPException(status_code=502, detail="Could not refresh the media URL")
+        fmt = find_progressive_format(raw_info, format_id)
+        if not fmt:
+            raise HTTPException(status_code=404, detail="Format not available for direct streaming")
+        
+        headers = dict(fmt.get('http_headers') or {})
+        headers['Accept-Encoding'] = 'identity'  # Pass bytes through untouched
+        for name in ('Range', 'If-Range'):
+            if name in request.headers:
+                headers[name] = request.headers[name]
+        
+        try:
+            upstream = await http_client.send(http_client.build_request('GET', fmt['url'], headers=headers), stream=True)
+        except httpx.HTTPError as e:
+            # Connect errors and timeouts: nothing was opened, so nothing to close
+            raise HTTPException(status_code=502, detail=f"CDN responded with an error: {type(e).__name__}")
+        if upstream.status_code in (403, 410) and attempt == 0:
+            # Signed URL expired early - re-extract once and retry
+            await upstream.aclose()
+            raw_info = await refresh_session_info(session_id, cached_data)
+            continue
+        break
+    
+    if upstream.status_code >= 400 and upstream.status_code != 416:
+        await upstream.aclose()
+        raise HTTPException(status_code=502, detail=f"CDN responded with {upstream.status_code}")
+    
+    title = sanitize_title(cached_data['info'].get('title') or 'instagram_content')
+    response_headers = {
+        name: upstream.headers[name] for name in PROXY_PASSTHROUGH_HEADERS if name in upstream.headers
+    }
+    response_headers.update({
+        "Content-Disposition": f"attachment; filename={title}.{fmt.get('ext', 'mp4')}",
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "GET",
+        "Access-Control-Allow-Headers": "*",
+    })
+    
+    return StreamingResponse(
+        upstream.aiter_raw(PROXY_CHUNK_SIZE),
+        status_code=upstream.status_code,
+        headers=response_headers,
+        background=BackgroundTask(upstream.aclose)
+    )
+
+# ✅ THUMBNAIL PROXY SETTINGS
+THUMB_SIZES = {'small': 160, 'medium': 480, 'large': 1080}  # longest side in pixels
+THUMB_CACHE_MAX_BYTES = int(os.environ.get('THUMB_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+THUMB_MAX_AGE = int(os.environ.get('THUMB_MAX_AGE', 86400))  # browser cache lifetime, seconds
+THUMB_QUALITY = int(os.environ.get('THUMB_QUALITY', 82))  # JPEG quality of resized variants
+
+class ThumbnailCache:
+    """Byte-bounded LRU of thumbnail bodies: key -> (etag, media type, bytes)
+    
+    Keyed by post shortcode rather than session, so every session for the same
+    post shares the fetched original and its resized variants.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, media_type, body):
+        """Store a body and return its (etag, media type, bytes) entry"""
+        entry = (f'"{hashlib.sha256(body).hexdigest()[:32]}"', media_type, body)
+        if len(body) > self.max_bytes:
+            return entry  # Served, never cached
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous:
+                self.bytes -= len(previous[2])
+            self._entries[key] = entry
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+        return entry
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+thumbnail_cache = ThumbnailCache(THUMB_CACHE_MAX_BYTES)
+
+def resize_thumbnail(body, max_side):
+    """Downscale an image so its longest side is at most max_side; returns JPEG bytes"""
+    with Image.open(io.BytesIO(body)) as image:
+        image.draft('RGB', (max_side, max_side))  # Lets JPEG decode at a reduced scale
+        image = image.convert('RGB')
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=THUMB_QUALITY, optimize=True, progressive=True)
+        return output.getvalue()
+
+async def fetch_thumbnail(session_id, cached_data):
+    """Fetch a session's original thumbnail over the pooled client; returns (media type, bytes)"""
+    raw_info = cached_data.get('raw_info') or {}
+    for attempt in range(2):
+        url = raw_info.get('thumbnail') or (cached_data['info'].get('thumbnail') if attempt == 0 else None)
+        if not url:
+            raise HTTPException(status_code=404, detail="No thumbnail for this post")
+        
+        try:
+            response = await http_client.get(url, headers=raw_info.get('http_headers'))
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"CDN responded with an error: {type(e).__name__}")
+        if response.status_code in (403, 410) and attempt == 0:
+            # Signed URL expired - re-extract once and retry
+            raw_info = await refresh_session_info(session_id, cached_data) or {}
+            continue
+        break
+    
+    if response.status_code >= 400:
+        raise HTTPException(status_code=502, detail=f"CDN responded with {response.status_code}")
+    return response.headers.get('content-type', 'image/jpeg').split(';')[0], response.content
+
+# Original fetches in flight per post (event loop only, no lock needed)
+inflight_thumbnails: Dict[str, asyncio.Future] = {}
+
+async def thumbnail_original(post_key, session_id, cached_data):
+    """Cached original thumbnail entry for a post; concurrent misses share one fetch
+    
+    The page asks for its src and srcset sizes at once, so without this every
+    size would fetch the same original from the CDN.
+    """
+    original = thumbnail_cache.get(f'{post_key}:original')
+    if original is not None:
+        return original
+    
+    pending = inflight_thumbnails.get(post_key)
+    if pending is None:
+        async def fetch():
+            media_type, body = await fetch_thumbnail(session_id, cached_data)
+            return thumbnail_cache.put(f'{post_key}:original', media_type, body)
+        
+        pending = asyncio.ensure_future(fetch())
+        inflight_thumbnails[post_key] = pending
+        pending.add_done_callback(lambda _: inflight_thumbnails.pop(post_key, None))
+    # Shield so a disconnecting first caller does not cancel it for the others
+    return await asyncio.shield(pending)
+
+@app.get("/thumb/{session_id}")
+async def thumbnail(session_id: str, request: Request, size: str = 'medium'):
+    """✅ SERVE A SESSION'S THUMBNAIL, RESIZED AND CACHED, FROM OUR OWN ORIGIN"""
+    if size not in THUMB_SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown size, use one of: {', '.join(THUMB_SIZES)}")
+    cached_data, session_error = await video_cache.lookup(session_id)
+    if session_error == 'session_expired':
+        raise HTTPException(status_code=410, detail="Session expired")
+    if session_error:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    post_key = extract_shortcode(cached_data['url']) or session_id
+    entry = thumbnail_cache.get(f'{post_key}:{size}')
+    if entry is None:
+        original = await thumbnail_original(post_key, session_id, cached_data)
+        try:
+            body = await asyncio.get_event_loop().run_in_executor(
+                None, resize_thumbnail, original[2], THUMB_SIZES[size]
+            )
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=f"Thumbnail could not be decoded: {e}")
+        entry = thumbnail_cache.put(f'{post_key}:{size}', 'image/jpeg', body)
+    
+    etag, media_type, body = entry
+    headers = {
+        "ETag": etag,
+        # The bytes for a given ETag never change, so browsers need not revalidate
+        "Cache-Control": f"public, max-age={THUMB_MAX_AGE}, immutable",
+        "Access-Control-Allow-Origin": "*",
+    }
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+# ✅ TEE MODE SETTINGS
+TEE_POLL_INTERVAL = float(os.environ.get('TEE_POLL_INTERVAL', 0.05))  # seconds between checks for new bytes
+TEE_ATTACH_TIMEOUT = int(os.environ.get('TEE_ATTACH_TIMEOUT', 120))  # max wait for the download to start
+TEE_CHUNK_SIZE = 256 * 1024
+
+async def attach_download(job_id):
+    """Wait for yt-dlp to open its .part file and open it for reading
+    
+    Returns None if the job fails, finishes first (the finished file is then
+    served normally) or does not start within TEE_ATTACH_TIMEOUT.
+    """
+    deadline = time.monotonic() + TEE_ATTACH_TIMEOUT
+    while time.monotonic() < deadline:
+        fields = await download_jobs.fields_async(job_id, 'status', 'partial_path')
+        if fields is None or fields[0] in TERMINAL_JOB_STATES:
+            return None
+        status, partial_path = fields
+        if partial_path and status == 'downloading':
+            try:
+                return open(partial_path, 'rb')
+            except FileNotFoundError:
+                # Renamed from .part between the lookup and the open
+                pass
+        await asyncio.sleep(TEE_POLL_INTERVAL)
+    return None
+
+async def follow_download(job_id, file):
+    """Yield a progressive download's bytes while yt-dlp is still writing them"""
+    loop = asyncio.get_event_loop()
+    
+    with file:
+        inode = os.fstat(file.fileno()).st_ino
+        while True:
+            chunk = await loop.run_in_executor(None, file.read, TEE_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+            
+            status, partial_path = await download_jobs.fields_async(job_id, 'status', 'partial_path') or ('failed', None)
+            if status in ('processing', 'completed'):
+                # The writer finished; drain whatever landed after the last read
+                while chunk := await loop.run_in_executor(None, file.read, TEE_CHUNK_SIZE):
+                    yield chunk
+                return
+            if status == 'failed':
+                return
+            try:
+                if partial_path and os.stat(partial_path).st_ino != inode:
+                    return  # A retry restarted the file; the client must re-request
+            except FileNotFoundError:
+                pass
+            await asyncio.sleep(TEE_POLL_INTERVAL)
+
+# ✅ FILE SERVING SETTINGS
+FILE_CHUNK_SIZE = int(os.environ.get('FILE_CHUNK_SIZE', 1024 * 1024))  # Read window when zero-copy is unavailable
+
+class FileRangeResponse(Response):
+    """Send an inclusive byte range of a file, zero-copy when the server allows it
+    
+    Servers that advertise the ASGI 'http.response.zerocopysend' extension
+    sendfile() straight from our descriptor. Otherwise the range is read in
+    FILE_CHUNK_SIZE windows off the event loop. The background task runs
+    once the transfer ends, including when the client disconnects.
+    """
+
+    def __init__(self, file_path, start, end, status_code=200, headers=None, media_type=None,
+                 background=None, chunk_size=FILE_CHUNK_SIZE):
+        self.file_path = file_path
+        self.start = start
+        self.length = end - start + 1
+        self.chunk_size = chunk_size
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = background
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': self.status_code,
+                'headers': self.raw_headers,
+            })
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                with open(self.file_path, 'rb') as file:
+                    await send({
+                        'type': 'http.response.zerocopysend',
+                        'file': file,
+                        'offset': self.start,
+                        'count': self.length,
+                        'more_body': False,
+                    })
+            else:
+                async with await anyio.open_file(self.file_path, 'rb') as file:
+                    await file.seek(self.start)
+                    remaining = self.length
+                    while remaining > 0:
+                        chunk = await file.read(min(self.chunk_size, remaining))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+                    if remaining != 0 or self.length <= 0:
+                        # Empty range (nothing was sent) or the file shrank underneath us: end the body rather than hang
+                        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if self.background is not None:
+                await self.background()
 
-@app.get("/download-file/{job_id}")
-async def download_file(job_id: str):
-    """✅ STREAM FILE AND AUTO-DELETE"""
+def parse_range_header(range_header, file_size):
+    """Parse a single 'bytes=' range into inclusive (start, end)
+    
+    Returns None when the header should be ignored (malformed or multiple
+    ranges, which are served as a full 200) and 'unsatisfiable' for 416.
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
     try:
-        with temp_files_lock:
-            if job_id not in temp_files:
-                raise HTTPException(status_code=404, detail="File not found or expired")
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0 or file_size == 0:
+                return 'unsatisfiable'
+            return max(file_size - length, 0), file_size - 1
+        start = int(first)
+        end = int(last) if last else file_size - 1
+    except ValueError:
+        return None
+    # Checked first: an open-ended range at EOF ('bytes=<size>-') is a 416, not a full 200
+    if start >= file_size:
+        return 'unsatisfiable'
+    if start > end:
+        return None
+    return start, min(end, file_size - 1)
+
+@app.api_route("/download-file/{job_id}", methods=["GET", "HEAD"])
+async def download_file(job_id: str, request: Request):
+    """✅ STREAM FILE WITH RANGE SUPPORT (AUTO-DELETED AFTER RETENTION)"""
+    # ✅ TEE MODE - ATTACH TO A PROGRESSIVE DOWNLOAD STILL IN PROGRESS
+    with temp_files_lock:
+        file_ready = job_id in temp_files
+    if not file_ready:
+        fields = await download_jobs.fields_async(job_id, 'status', 'streamable', 'expected_size', 'video_title', 'ext')
+        if fields and fields[1] and fields[0] in ('queued', 'downloading', 'processing'):
+            status, _, expected_size, video_title, ext = fields
+            # Attach before answering, so a 200 with Content-Length is only sent once bytes can follow
+            file = await attach_download(job_id)
+            if file is None:
+                status = (await download_jobs.fields_async(job_id, 'status') or ('failed',))[0]
+                if status == 'failed':
+                    raise HTTPException(status_code=404, detail="Download failed")
+                if status != 'completed':
+                    raise HTTPException(
+                        status_code=409,
+                        detail=f"Download has not started yet; follow /status/{job_id} and retry"
+                    )
+                return await download_file(job_id, request)  # Finished while waiting; serve the file
             
-            file_info = temp_files[job_id]
-            file_path = file_info['file_path']
-            filename = file_info['filename']
+            filename = f"{sanitize_title(video_title or 'instagram_content')}.{ext or 'mp4'}"
+            headers = {
+                "Content-Disposition": f"attachment; filename={filename}",
+                "Access-Control-Allow-Origin": "*",
+                "Access-Control-Allow-Methods": "GET",
+                "Access-Control-Allow-Headers": "*",
+            }
+            if expected_size:
+                headers["Content-Length"] = str(expected_size)
+            return StreamingResponse(
+                follow_download(job_id, file),
+                media_type="video/webm" if ext == 'webm' else "video/mp4",
+                headers=headers
+            )
+    
+    file_info = pin_temp_file(job_id)
+    if file_info is None and shared_state:
+        # Written by a sibling worker; unpinning below is a no-op for it
+        file_info = await shared_state.get_async('file', job_id)
+    if file_info is None:
+        raise HTTPException(status_code=404, detail="File not found or expired")
+    
+    streaming = False
+    try:
+        file_path = file_info['file_path']
+        filename = file_info['filename']
         
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail="File not found")
         
-        # ✅ STREAM FILE CONTENT
-        def file_generator():
-            try:
-                with open(file_path, 'rb') as file:
-                    while chunk := file.read(8192):  # 8KB chunks
-                        yield chunk
-            finally:
-                # ✅ IMMEDIATE CLEANUP AFTER STREAMING
-                try:
-                    if os.path.exists(file_info['temp_dir']):
-                        shutil.rmtree(file_info['temp_dir'])
-                    with temp_files_lock:
-                        if job_id in temp_files:
-                            del temp_files[job_id]
-                except Exception as cleanup_error:
-                    print(f"Cleanup error: {cleanup_error}")
+        stat = os.stat(file_path)
+        file_size = stat.st_size
+        etag = f'"{stat.st_ino:x}-{file_size:x}-{stat.st_mtime_ns:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
         
         # Determine content type
         content_type = "video/mp4"
         if filename.endswith('.mp3'):
             content_type = "audio/mpeg"
+        elif filename.endswith('.m4a'):
+            content_type = "audio/mp4"
         elif filename.endswith('.webm'):
             content_type = "video/webm"
+        else:
+            ext = os.path.splitext(filename)[1].lstrip('.')
+            content_type = next((mime for mime, image_ext in IMAGE_EXTENSIONS.items() if image_ext == ext), content_type)
+        
+        headers = {
+            "Content-Disposition": f"attachment; filename={filename}",
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "GET",
+            "Access-Control-Allow-Headers": "*",
+        }
         
-        return StreamingResponse(
-            file_generator(),
+        # ✅ RANGE REQUESTS - RESUMES ONLY SEND THE MISSING BYTES
+        status_code = 200
+        start, end = 0, file_size - 1
+        range_header = request.headers.get('range')
+        if_range = request.headers.get('if-range')
+        if range_header and (not if_range or if_range in (etag, last_modified)):
+            byte_range = parse_range_header(range_header, file_size)
+            if byte_range == 'unsatisfiable':
+                return Response(
+                    status_code=416,
+                    headers={**headers, "Content-Range": f"bytes */{file_size}"}
+                )
+            if byte_range:
+                start, end = byte_range
+                status_code = 206
+                headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        
+        if request.method == 'HEAD':
+            return Response(status_code=status_code, headers=headers, media_type=content_type)
+        
+        # ✅ STREAM FILE CONTENT (ZERO-COPY WHERE SUPPORTED)
+        # The file stays until its retention window expires; only the pin is dropped
+        response = FileRangeResponse(
+            file_path,
+            start,
+            end,
+            status_code=status_code,
+            headers=headers,
             media_type=content_type,
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET",
-                "Access-Control-Allow-Headers": "*",
-            }
+            background=BackgroundTask(unpin_temp_file, job_id)
         )
+        streaming = True
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error serving file: {str(e)}")
+    finally:
+        if not streaming:
+            unpin_temp_file(job_id)
+
+# ✅ STREAMING ZIP SETTINGS
+ZIP_MAX_MEMBERS = int(os.environ.get('ZIP_MAX_MEMBERS', 50))
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+class ZipStreamSink:
+    """Write-only, unseekable file object for zipfile; output is collected until drained"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        # No seek(), so zipfile streams with data descriptors instead of rewriting headers
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def zip_member_name(filename, used):
+    """Archive name for a file, numbered when several jobs share a title"""
+    name = filename
+    stem, ext = os.path.splitext(filename)
+    counter = 2
+    while name in used:
+        name = f"{stem} ({counter}){ext}"
+        counter += 1
+    used.add(name)
+    return name
+
+async def job_file_ids(job_id):
+    """Files behind a job: its own, or one per finished item of a carousel job"""
+    fields = await download_jobs.fields_async(job_id, 'items')
+    if not fields or not fields[0]:
+        return [job_id]
+    return [item['file_id'] for item in fields[0] if item.get('file_id')]
+
+def stream_zip(job_ids):
+    """Yield a store-mode ZIP of the given files, releasing each one once it is written
+    
+    Runs in Starlette's thread pool. Memory stays at about one read window,
+    because everything written to the sink is yielded before the next read.
+    """
+    members = []
+    try:
+        for job_id in job_ids:
+            file_info = pin_temp_file(job_id)
+            if file_info is not None:
+                members.append((job_id, file_info, True))
+            elif shared_state and (file_info := shared_state.get('file', job_id)):
+                members.append((job_id, file_info, False))  # Owned by a sibling worker
+        
+        sink = ZipStreamSink()
+        used_names = set()
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+            while members:
+                job_id, file_info, local = members[0]
+                with open(file_info['file_path'], 'rb') as source:
+                    stat = os.fstat(source.fileno())
+                    member = zipfile.ZipInfo(
+                        zip_member_name(file_info['filename'], used_names),
+                        date_time=max(time.localtime(stat.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+                    )
+                    member.file_size = stat.st_size  # Lets zipfile decide on zip64 up front
+                    with archive.open(member, 'w') as target:
+                        while chunk := source.read(ZIP_CHUNK_SIZE):
+                            target.write(chunk)
+                            yield sink.drain()
+                yield sink.drain()
+                
+                members.pop(0)
+                if local:
+                    unpin_temp_file(job_id)
+                    expire_temp_file(job_id)
+        yield sink.drain()  # Central directory
+    finally:
+        for job_id, _, local in members:
+            if local:
+                unpin_temp_file(job_id)
+
+@app.get("/download-zip")
+async def download_zip(job_ids: str):
+    """✅ STREAM SEVERAL FINISHED DOWNLOADS AS ONE ZIP, BUILT ON THE FLY"""
+    requested = [job_id.strip() for job_id in job_ids.split(',') if job_id.strip()]
+    ids = list(dict.fromkeys([file_id for job_id in requested for file_id in await job_file_ids(job_id)]))
+    if not ids:
+        raise HTTPException(status_code=400, detail="No job IDs given")
+    if len(ids) > ZIP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"Too many files (max {ZIP_MAX_MEMBERS} per archive)")
+    
+    with temp_files_lock:
+        missing = [job_id for job_id in ids if job_id not in temp_files]
+    if shared_state:
+        missing = [job_id for job_id in missing if not await shared_state.get_async('file', job_id)]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"File not found or expired: {', '.join(missing)}")
+    
+    return StreamingResponse(
+        stream_zip(ids),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename=instagram_{len(ids)}_files.zip",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "GET",
+            "Access-Control-Allow-Headers": "*",
+        }
+    )
+
+# ✅ PROMETHEUS METRICS
+METRIC_ROUTES = (
+    '/extract/batch', '/extract', '/download-file', '/download-zip', '/download',
+    '/proxy', '/thumb', '/status', '/cancel'
+)  # /events is left out: its streams stay open for the whole job
+
+def metric_route(path):
+    """Route label for a request path, or None for paths that are not timed"""
+    for route in METRIC_ROUTES:
+        if path == route or path.startswith(route + '/'):
+            return route
+    return None
+
+class RequestMetricsMiddleware:
+    """Time requests until their last body byte is sent and count error statuses
+    
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed and zero-copy
+    responses pass through untouched and the per-request cost stays tiny.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        route = metric_route(scope['path']) if scope['type'] == 'http' else None
+        if route is None:
+            return await self.app(scope, receive, send)
+        
+        started = time.monotonic()
+        status = [500]
+        
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_request_duration.observe(time.monotonic() - started, route=route)
+            if status[0] >= 400:
+                errors_total.inc(stage='http', error_type=f'http_{status[0]}')
+
+app.add_middleware(RequestMetricsMiddleware)
+
+def render_gauge(name, description, samples, labels=()):
+    """Exposition lines for a gauge; samples are (label values, value) pairs"""
+    yield f'# HELP {name} {description}'
+    yield f'# TYPE {name} gauge'
+    for key, value in samples:
+        yield f'{name}{metric_labels(labels, key)} {value}'
+
+def temp_files_bytes():
+    """Bytes held by finished job files that the media cache does not account for"""
+    with temp_files_lock:
+        paths = [info['file_path'] for info in temp_files.values() if not info.get('cache_key')]
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+def render_metrics():
+    """Every metric in the Prometheus text format; gauges are read from existing stats at scrape time"""
+    lines = []
+    for metric in (http_request_duration, ytdlp_attempt_duration, download_duration,
+                   queue_wait_duration, postprocess_duration, errors_total):
+        lines.extend(metric.render())
+    
+    queue_stats = download_queue.stats()
+    stage_stats = postprocess_stage.stats()
+    disk = shutil.disk_usage(tempfile.gettempdir())
+    caches = {
+        'extract': extract_cache.stats(),
+        'negative': negative_cache.stats(),
+        'media': media_cache.stats(),
+        'thumbnail': thumbnail_cache.stats()
+    }
+    gauges = [
+        ('instagram_executor_queue_depth', 'Calls waiting for a thread in the yt-dlp executor',
+         [((), executor.queue_depth())], ()),
+        ('instagram_executor_busy_threads', 'yt-dlp executor threads running a call',
+         [((), executor.busy)], ()),
+        ('instagram_executor_max_threads', 'yt-dlp executor size',
+         [((), executor.max_workers)], ()),
+        ('instagram_download_queue_depth', 'Download jobs waiting for a worker, per priority lane',
+         [((lane,), depth) for lane, depth in queue_stats['lanes'].items()], ('lane',)),
+        ('instagram_download_workers_busy', 'Download workers running a job',
+         [((), queue_stats['active'])], ()),
+        ('instagram_postprocess_queued', 'Jobs waiting for an ffmpeg slot',
+         [((), stage_stats['queued'])], ()),
+        ('instagram_postprocess_active', 'ffmpeg processes running',
+         [((), stage_stats['active'])], ()),
+        ('instagram_jobs', 'Download jobs in the registry by status',
+         [((status,), count) for status, count in download_jobs.counts().items()], ('status',)),
+        ('instagram_sessions', 'Download sessions held in memory',
+         [((), len(video_cache))], ()),
+        ('instagram_temp_files_bytes', 'Bytes of finished job files outside the media cache',
+         [((), temp_files_bytes())], ()),
+        ('instagram_media_cache_bytes', 'Bytes of files held by the media cache',
+         [((), caches['media']['bytes'])], ()),
+        ('instagram_temp_volume_bytes', 'Usage of the volume holding temp files',
+         [(('used',), disk.used), (('free',), disk.free)], ('kind',)),
+        ('instagram_cache_hit_ratio', 'Lifetime hit ratio per cache',
+         [((name,), stats['hit_ratio']) for name, stats in caches.items()], ('cache',)),
+        ('instagram_circuit_breaker_open', '1 while the circuit breaker is open or half-open',
+         [((), int(circuit_breaker.stats()['state'] != 'closed'))], ()),
+    ]
+    for name, description, samples, labels in gauges:
+        lines.extend(render_gauge(name, description, samples, labels))
+    
+    for kind in ('hits', 'misses'):
+        name = f'instagram_cache_{kind}_total'
+        lines.append(f'# HELP {name} Lifetime cache {kind} per cache')
+        lines.append(f'# TYPE {name} counter')
+        lines.extend(f'{name}{metric_labels(("cache",), (cache,))} {stats[kind]}' for cache, stats in caches.items())
+    
+    return '\n'.join(lines) + '\n'
+
+@app.get("/metrics")
+async def metrics():
+    """✅ PROMETHEUS SCRAPE ENDPOINT"""
+    return Response(content=render_metrics(), media_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.get("/health")
 async def health_check():
     """Health check with enhanced cloud info"""
     with temp_files_lock:
         temp_files_count = len(temp_files)
+    job_counts = download_jobs.counts()
     
     return JSONResponse(
         status_code=200,
@@ -1591,8 +4759,24 @@ async def health_check():
             ],
             'supported_content': ['posts', 'reels', 'igtv'],
             'not_supported': ['stories'],
-            'active_downloads': len(download_jobs),
+            'active_downloads': sum(count for state, count in job_counts.items() if state not in TERMINAL_JOB_STATES),
+            'jobs': job_counts,
             'temp_files': temp_files_count,
+            'temp_reaper': temp_reaper.stats(),
+            'sessions': video_cache.stats(),
+            'state_backend': state_backend.stats(),
+            'extract_cache': extract_cache.stats(),
+            'negative_cache': negative_cache_snapshot(),
+            'extract_coalescing': coalescing_snapshot(),
+            'media_cache': media_cache.stats(),
+            'thumbnail_cache': thumbnail_cache.stats(),
+            'retry_scheduler': retry_metrics_snapshot(),
+            'postprocessing': postprocess_metrics_snapshot(),
+            'postprocess_stage': postprocess_stage.stats(),
+            'rate_governor': rate_governor.stats(),
+            'circuit_breaker': circuit_breaker.stats(),
+            'download_queue': download_queue.stats(),
+            'event_subscribers': job_events.subscriber_count(),
             'cloud_optimizations': [
                 'Randomized headers and user agents',
                 'Progressive retry with backoff',
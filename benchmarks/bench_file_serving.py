@@ -0,0 +1,111 @@
+"""Compare file serving strategies used by /download-file.
+
+Sends the same file over a local socket three ways and reports throughput
+and sender CPU time per GB:
+
+  generator-8k   the old file_generator (8 KB reads, one Python yield each)
+  window-<size>  FileRangeResponse's fallback path (large read windows)
+  sendfile       os.sendfile, what servers with zero-copy send do
+
+Usage: python benchmarks/bench_file_serving.py [size_mb] [window_kb]
+"""
+import os
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+
+def drain(sock):
+    """Read and discard everything until the sender closes"""
+    while sock.recv_into(bytearray(1024 * 1024)):
+        pass
+
+
+def sender_cpu():
+    # Per-thread where available so the drain thread is not counted
+    usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF))
+    return usage.ru_utime + usage.ru_stime
+
+
+def serve_generator(path, sock, chunk_size):
+    def file_generator():
+        with open(path, 'rb') as file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+
+    for chunk in file_generator():
+        sock.sendall(chunk)
+
+
+def serve_window(path, sock, chunk_size):
+    with open(path, 'rb') as file:
+        remaining = os.fstat(file.fileno()).st_size
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            sock.sendall(chunk)
+
+
+def serve_sendfile(path, sock, chunk_size):
+    with open(path, 'rb') as file:
+        offset, remaining = 0, os.fstat(file.fileno()).st_size
+        while remaining > 0:
+            sent = os.sendfile(sock.fileno(), file.fileno(), offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+
+
+def run(name, serve, path, size, chunk_size):
+    sender, receiver = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(receiver,))
+    reader.start()
+
+    cpu_before = sender_cpu()
+    started = time.perf_counter()
+    serve(path, sender, chunk_size)
+    sender.shutdown(socket.SHUT_WR)
+    elapsed = time.perf_counter() - started
+    cpu = sender_cpu() - cpu_before
+
+    reader.join()
+    sender.close()
+    receiver.close()
+
+    gigabytes = size / 1024 ** 3
+    print(f"{name:<16} {size / 1024 ** 2 / elapsed:>10.1f} MB/s {cpu / gigabytes:>10.3f} CPU s/GB")
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    window_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    size = size_mb * 1024 ** 2
+
+    with tempfile.NamedTemporaryFile(prefix='instagram_bench_', delete=False) as file:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size_mb):
+            file.write(block)
+        path = file.name
+
+    try:
+        # Warm the page cache so every run reads from memory
+        with open(path, 'rb') as file:
+            while file.read(1024 * 1024):
+                pass
+        print(f"{size_mb} MB file, {window_kb} KB window")
+        run('generator-8k', serve_generator, path, size, 8192)
+        run(f'window-{window_kb}k', serve_window, path, size, window_kb * 1024)
+        if hasattr(os, 'sendfile'):
+            run('sendfile', serve_sendfile, path, size, 0)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
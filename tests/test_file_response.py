@@ -0,0 +1,68 @@
+"""FileRangeResponse always finishes its body, including for empty files and ranges"""
+import asyncio
+
+import pytest
+
+from app import FileRangeResponse
+
+
+def serve(response, scope=None):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def receive():
+        return {'type': 'http.disconnect'}
+
+    asyncio.run(response(scope or {'type': 'http'}, receive, send))
+    return messages
+
+
+def body_of(messages):
+    bodies = [message for message in messages if message['type'] == 'http.response.body']
+    assert bodies, 'no body frame sent'
+    assert bodies[-1]['more_body'] is False, 'response never completed'
+    assert all(message['more_body'] for message in bodies[:-1])
+    return b''.join(message['body'] for message in bodies)
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(bytes(range(256)) * 40)  # 10240 bytes
+    return path
+
+
+def test_zero_length_file_completes(tmp_path):
+    path = tmp_path / 'empty.mp4'
+    path.write_bytes(b'')
+    messages = serve(FileRangeResponse(str(path), 0, -1))
+    assert messages[0]['type'] == 'http.response.start'
+    assert body_of(messages) == b''
+
+
+def test_empty_range_completes(data_file):
+    # start > end gives a zero-length range, as when only headers are wanted
+    assert body_of(serve(FileRangeResponse(str(data_file), 100, 99, status_code=206))) == b''
+
+
+def test_range_is_sent_in_windows(data_file):
+    messages = serve(FileRangeResponse(str(data_file), 10, 5009, status_code=206, chunk_size=1024))
+    assert body_of(messages) == data_file.read_bytes()[10:5010]
+    assert len([message for message in messages if message['type'] == 'http.response.body']) == 5
+
+
+def test_file_shorter_than_range_still_completes(data_file):
+    body = body_of(serve(FileRangeResponse(str(data_file), 10000, 20000, status_code=206)))
+    assert body == data_file.read_bytes()[10000:]
+
+
+def test_background_runs_after_body(data_file):
+    ran = []
+
+    async def background():
+        ran.append(True)
+
+    serve(FileRangeResponse(str(data_file), 0, 9, background=background))
+    assert ran == [True]
@@ -0,0 +1,37 @@
+"""parse_range_header: which Range headers give 206, 416 or a full 200"""
+import pytest
+
+from app import parse_range_header
+
+SIZE = 10240
+
+
+@pytest.mark.parametrize('header, expected', [
+    # Plain and open-ended ranges
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, SIZE - 1)),
+    ('bytes=0-', (0, SIZE - 1)),
+    ('bytes=10000-99999', (10000, SIZE - 1)),  # End past EOF is clamped
+    ('BYTES = 5-9', (5, 9)),
+    # Suffix ranges: the last N bytes
+    ('bytes=-500', (SIZE - 500, SIZE - 1)),
+    ('bytes=-99999', (0, SIZE - 1)),
+    ('bytes=-0', 'unsatisfiable'),
+    # At or past EOF: 416 so a resuming client knows it already has everything
+    ('bytes=10240-', 'unsatisfiable'),
+    ('bytes=99999-', 'unsatisfiable'),
+    ('bytes=10240-10300', 'unsatisfiable'),
+    # Ignored, served as a full 200
+    ('bytes=0-10,20-30', None),
+    ('bytes=500-100', None),
+    ('items=0-10', None),
+    ('bytes=abc-', None),
+    ('bytes=-', None),
+])
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, SIZE) == expected
+
+
+def test_empty_file_has_no_satisfiable_range():
+    assert parse_range_header('bytes=0-', 0) == 'unsatisfiable'
+    assert parse_range_header('bytes=-10', 0) == 'unsatisfiable'
@@ -0,0 +1,140 @@
+"""RedisBackend against a local RESP stand-in (no Redis server needed)"""
+import io
+import socket
+import threading
+import time
+
+import pytest
+
+from app import RedisBackend, RedisError
+
+
+class RespStandIn:
+    """Single-connection-per-thread RESP server that knows GET, SET [EX] and DEL"""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        reader = conn.makefile('rb')
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:-2])):
+                length = int(reader.readline()[1:-2])
+                args.append(reader.read(length + 2)[:-2])
+            conn.sendall(self._reply(args))
+
+    def _reply(self, args):
+        command = args[0].decode().upper()
+        self.commands.append(command)
+        if command == 'GET':
+            value = self.data.get(args[1])
+            if value is None or (value[1] and value[1] <= time.monotonic()):
+                return b'$-1\r\n'
+            return b'$%d\r\n%s\r\n' % (len(value[0]), value[0])
+        if command == 'SET':
+            ttl = int(args[4]) if len(args) > 4 and args[3].upper() == b'EX' else None
+            self.data[args[1]] = (args[2], time.monotonic() + ttl if ttl else None)
+            return b'+OK\r\n'
+        if command == 'DEL':
+            return b':%d\r\n' % (self.data.pop(args[1], None) is not None)
+        return b'-ERR unknown command\r\n'
+
+    def close(self):
+        self.server.close()
+
+
+@pytest.fixture
+def stand_in():
+    server = RespStandIn()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def backend(stand_in):
+    return RedisBackend(f'redis://127.0.0.1:{stand_in.port}/0')
+
+
+def test_set_get_delete_round_trip(backend, stand_in):
+    backend.set('session', 'abc', {'url': 'https://instagram.com/p/x', 'items': [1, 2]}, 60)
+    assert backend.get('session', 'abc') == {'url': 'https://instagram.com/p/x', 'items': [1, 2]}
+    assert b'igdl:session:abc' in stand_in.data
+
+    backend.delete('session', 'abc')
+    assert backend.get('session', 'abc') is None
+    assert stand_in.commands == ['SET', 'GET', 'DEL', 'GET']
+
+
+def test_missing_key_is_none(backend):
+    assert backend.get('job', 'nope') is None
+    assert backend.errors == 0
+
+
+def test_set_passes_ttl_as_ex(backend, stand_in):
+    backend.set('file', 'job1', {'file_path': '/tmp/x'}, 0.2)  # Rounded up to the 1 s minimum
+    _, expires_at = stand_in.data[b'igdl:file:job1']
+    assert 0.5 < expires_at - time.monotonic() <= 1
+
+
+def test_async_helpers_run_off_the_loop(backend):
+    import asyncio
+
+    async def scenario():
+        await asyncio.wrap_future(backend.set_later('job', 'j', {'status': 'queued'}, 60))
+        return await backend.get_async('job', 'j')
+
+    assert asyncio.run(scenario()) == {'status': 'queued'}
+
+
+def test_error_reply_is_counted_not_raised(backend):
+    assert backend.take_tokens('instagram', 1.0, 10, 1) is None  # EVAL is unknown to the stand-in
+    assert backend.errors == 1
+
+
+def test_unreachable_server_degrades(stand_in):
+    stand_in.close()
+    backend = RedisBackend(f'redis://127.0.0.1:{stand_in.port}/0', timeout=0.2)
+    assert backend.get('session', 'abc') is None
+    backend.set('session', 'abc', {}, 60)
+    assert backend.errors == 2
+
+
+@pytest.mark.parametrize('raw, expected', [
+    (b'+OK\r\n', 'OK'),
+    (b':42\r\n', 42),
+    (b'$5\r\nhello\r\n', b'hello'),
+    (b'$0\r\n\r\n', b''),
+    (b'$-1\r\n', None),
+    (b'*-1\r\n', None),
+    (b'*3\r\n$1\r\na\r\n:7\r\n$-1\r\n', [b'a', 7, None]),
+    (b'*2\r\n*1\r\n+x\r\n$2\r\n\r\n\r\n', [['x'], b'\r\n']),
+])
+def test_read_reply(raw, expected):
+    backend = RedisBackend('redis://127.0.0.1:6379/0')
+    assert backend._read_reply(io.BytesIO(raw)) == expected
+
+
+def test_read_reply_error_and_truncation():
+    backend = RedisBackend('redis://127.0.0.1:6379/0')
+    with pytest.raises(RedisError, match='WRONGTYPE'):
+        backend._read_reply(io.BytesIO(b'-WRONGTYPE bad\r\n'))
+    with pytest.raises(ConnectionError):
+        backend._read_reply(io.BytesIO(b'$5\r\nhel'))
+    with pytest.raises(ConnectionError):
+        backend._read_reply(io.BytesIO(b''))